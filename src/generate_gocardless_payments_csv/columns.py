@@ -0,0 +1,28 @@
+"""
+Columns of the GoCardless customer export and payment CSVs
+"""
+
+REQUIRED_CUSTOMER_COLUMNS = frozenset({
+    "mandate.id",
+    "customer.id",
+    "customer.given_name",
+    "customer.family_name",
+    "customer.company_name",
+    "customer.email",
+})
+
+# Map invoice csv to GoCardless payment csv
+GOCARDLESS_COLUMNS = [
+    "mandate.id",
+    "customer.id",
+    "customer.given_name",
+    "customer.family_name",
+    "customer.company_name",
+    "customer.email",
+    "payment.amount",
+    "payment.currency",
+    "payment.description",
+    "payment.charge_date",
+    "payment.metadata.INVOICE_ID",
+    "payment.metadata.INVOICE_DATE",
+]
@@ -0,0 +1,104 @@
+"""
+Index of GoCardless customers by normalized email address
+"""
+from collections import Counter, defaultdict
+import difflib
+from typing import Dict, Hashable, Iterable, List, Optional, Set
+
+# Domains ignoring dots in the local part of the address
+GMAIL_DOMAINS = {"gmail.com", "googlemail.com"}
+
+
+def exact_email(email) -> str:
+    """Email address as typed, only trimmed and case folded"""
+    if not isinstance(email, str):
+        return ""
+    return email.strip().casefold()
+
+
+def normalize_email(email) -> str:
+    """
+    Canonical form of an email address, used to match invoice requests with GoCardless customers:
+    trimmed, case folded, without `+tag` sub-address, and without dots for gmail addresses
+    """
+    if not isinstance(email, str):
+        return ""
+    email = email.strip().casefold()
+    local_part, separator, domain = email.rpartition("@")
+    if not separator:
+        return email
+    local_part = local_part.split("+", 1)[0]
+    if domain in GMAIL_DOMAINS:
+        local_part = local_part.replace(".", "")
+        domain = "gmail.com"
+    return f"{local_part}@{domain}"
+
+
+class CustomerEmailIndex:
+    """
+    Customers indexed by email address.
+
+    `matches` finds the customer with the same email address, trimmed and case folded (the last one when
+    several customers share it, as for the GoCardless export deduplication). Only when there is none, it
+    falls back to the customers with the same normalized email address: sub-addresses such as
+    `family+smith@` and `family+jones@` may belong to distinct customers, in which case the match is
+    ambiguous. Customers are told apart by their `identities` (e.g. customer and mandate ids), by position
+    by default.
+    `suggest` finds the closest customer email addresses for an unmatched address: candidates sharing
+    trigrams of the local part are looked up in an inverted index, then ranked by similarity.
+    """
+
+    def __init__(self, emails: Iterable[str], identities: Optional[Iterable[Hashable]] = None):
+        self.emails = list(emails)
+        identities = list(identities) if identities is not None else list(range(len(self.emails)))
+        self._exact_positions: Dict[str, int] = {}
+        # Last position of each distinct customer, by normalized email
+        self._normalized_positions: Dict[str, Dict[Hashable, int]] = defaultdict(dict)
+        self._positions: Dict[str, int] = {}
+        self._trigram_index: Dict[str, Set[str]] = defaultdict(set)
+
+        for position, (email, identity) in enumerate(zip(self.emails, identities)):
+            key = normalize_email(email)
+            if not key:
+                continue
+            self._exact_positions[exact_email(email)] = position
+            customer_positions = self._normalized_positions[key]
+            customer_positions.pop(identity, None)
+            customer_positions[identity] = position
+            self._positions[key] = position
+            for trigram in _local_part_trigrams(key):
+                self._trigram_index[trigram].add(key)
+
+    def matches(self, email) -> List[int]:
+        """
+        Positions of the customers matching an email address: a single one, none,
+        or several for an ambiguous normalized email address
+        """
+
+        position = self._exact_positions.get(exact_email(email))
+        if position is not None:
+            return [position]
+        return list(self._normalized_positions.get(normalize_email(email), {}).values())
+
+    def lookup(self, email) -> Optional[int]:
+        """Position of the customer matching an email address, None if there is none or the match is ambiguous"""
+
+        matches = self.matches(email)
+        return matches[0] if len(matches) == 1 else None
+
+    def suggest(self, email, limit: int = 3, candidate_count: int = 50) -> List[int]:
+        """Positions of the customers with the closest email addresses"""
+
+        key = normalize_email(email)
+        shared_trigram_counts: Counter = Counter()
+        for trigram in _local_part_trigrams(key):
+            shared_trigram_counts.update(self._trigram_index.get(trigram, ()))
+
+        candidates = [candidate for candidate, _ in shared_trigram_counts.most_common(candidate_count)]
+        candidates.sort(key=lambda candidate: difflib.SequenceMatcher(None, key, candidate).ratio(), reverse=True)
+        return [self._positions[candidate] for candidate in candidates[:limit]]
+
+
+def _local_part_trigrams(key: str) -> Set[str]:
+    padded_local_part = f"^{key.rpartition('@')[0] or key}$"
+    return {padded_local_part[i:i + 3] for i in range(len(padded_local_part) - 2)}
@@ -0,0 +1,372 @@
+"""
+Transform invoice requests into GoCardless payments
+"""
+from concurrent.futures import ProcessPoolExecutor
+import functools
+import logging
+from typing import Dict, List, Optional, Tuple
+import pandas
+
+from generate_gocardless_payments_csv.columns import GOCARDLESS_COLUMNS, REQUIRED_CUSTOMER_COLUMNS
+from generate_gocardless_payments_csv.customer_index import CustomerEmailIndex, exact_email
+from shared.csv_utils import process_csv_with_metadata
+from shared.row_utils import get_column_schema
+
+logger = logging.getLogger(__name__)
+
+
+def process_payments(
+    gocardless_payment_template_df: pandas.DataFrame,
+    raw_invoice_df: pandas.DataFrame,
+    invoice_id_prefix: str,
+    invoice_date: str,
+    invoice_customer_id_field: str,
+    invoice_gocardless_email_field: str,
+    invoice_total_amount_field: str,
+    invoice_payment_method_field: Optional[str],
+    invoice_payment_method_value: Optional[str],
+    workers: int = 1,
+) -> pandas.DataFrame:
+    """
+    Validate the invoice requests, join them with the GoCardless customers and scatter them over payments.
+
+    With `workers > 1`, the invoice requests are partitioned by a hash of the customer id and each partition
+    is validated, joined and scattered in a separate process. All invoices of a customer land in the same
+    partition, so the duplicate customer check stays exact. The cumulative totals are checked once all
+    partitions are merged back in the original order, so the output is identical to the serial path.
+    """
+
+    return process_prepared_payments(
+        gocardless_customers_df=prepare_gocardless_customers(gocardless_payment_template_df),
+        invoice_df=process_csv_with_metadata(raw_invoice_df),
+        invoice_id_prefix=invoice_id_prefix,
+        invoice_date=invoice_date,
+        invoice_customer_id_field=invoice_customer_id_field,
+        invoice_gocardless_email_field=invoice_gocardless_email_field,
+        invoice_total_amount_field=invoice_total_amount_field,
+        invoice_payment_method_field=invoice_payment_method_field,
+        invoice_payment_method_value=invoice_payment_method_value,
+        workers=workers,
+    )
+
+
+def prepare_gocardless_customers(gocardless_payment_template_df: pandas.DataFrame) -> pandas.DataFrame:
+    """
+    Check the GoCardless customer export and keep one customer per email, without payment columns.
+
+    Only depends on the customer export, so that it can be kept across runs on changing invoice requests.
+    """
+
+    # GoCardless: ensure all required customer columns are present
+    missing_gocardless_customer_df_columns = REQUIRED_CUSTOMER_COLUMNS.difference(
+        gocardless_payment_template_df.columns
+    )
+    assert len(missing_gocardless_customer_df_columns) == 0, (
+        f"Missing required columns from gocardless customer csv: \n"
+        f"{missing_gocardless_customer_df_columns}"
+    )
+
+    # Gocardless: drop duplicates, keeping the last customer with each email
+    duplicate_customer_email_idx = gocardless_payment_template_df['customer.email'] \
+        .map(exact_email) \
+        .duplicated(keep='last')
+    gocardless_customers_df = gocardless_payment_template_df[~duplicate_customer_email_idx]
+
+    # Gocardless: drop all pre-generated payment columns from gocardless csv
+    non_payment_cols = [col for col in gocardless_payment_template_df.columns if "payment." not in col]
+    return gocardless_customers_df[non_payment_cols]
+
+
+def build_customer_index(gocardless_customers_df: pandas.DataFrame) -> CustomerEmailIndex:
+    """Email index of customers prepared with `prepare_gocardless_customers`, by position"""
+
+    return CustomerEmailIndex(
+        gocardless_customers_df['customer.email'],
+        identities=zip(gocardless_customers_df['customer.id'], gocardless_customers_df['mandate.id']),
+    )
+
+
+def process_prepared_payments(
+    gocardless_customers_df: pandas.DataFrame,
+    invoice_df: pandas.DataFrame,
+    invoice_id_prefix: str,
+    invoice_date: str,
+    invoice_customer_id_field: str,
+    invoice_gocardless_email_field: str,
+    invoice_total_amount_field: str,
+    invoice_payment_method_field: Optional[str],
+    invoice_payment_method_value: Optional[str],
+    workers: int = 1,
+    customer_index: Optional[CustomerEmailIndex] = None,
+) -> pandas.DataFrame:
+    """
+    `process_payments` on customers prepared with `prepare_gocardless_customers` and invoice requests
+    already processed with `process_csv_with_metadata`.
+
+    `customer_index` is built with `build_customer_index` if not given.
+    """
+
+    # Invoice request: Ensure all required columns are present
+    required_invoice_columns = {
+        invoice_customer_id_field,
+        invoice_gocardless_email_field,
+        invoice_total_amount_field,
+    }
+    if invoice_payment_method_field:
+        required_invoice_columns.add(invoice_payment_method_field)
+
+    missing_invoice_df_columns = required_invoice_columns.difference(invoice_df.columns)
+    assert len(missing_invoice_df_columns) == 0, (
+        f"Missing required columns from invoice csv: \n"
+        f"{missing_invoice_df_columns}"
+    )
+
+    if bool(invoice_payment_method_field) != bool(invoice_payment_method_value):
+        raise ValueError("--invoice-payment-method-field and --invoice-payment-method-value must be provided together")
+
+    schema = get_column_schema(invoice_df.columns)
+    item_line_amount_columns = list(schema.indexed_columns("item_lines", "amount", numbered=True).values())
+    assert item_line_amount_columns, (
+        "There must be `item_lines.<number>.amount` columns in the invoice request csv"
+    )
+
+    # Payment amount and charge date columns, by payment id
+    payment_amount_columns = schema.indexed_columns("payments", "amount", numbered=True)
+    assert payment_amount_columns, (
+        "There must be `payments.<number>.amount` columns in the invoice request csv"
+    )
+    payment_charge_date_columns = {
+        payment_id: schema.column("payments", payment_id, "charge_date") for payment_id in payment_amount_columns
+    }
+
+    if customer_index is None:
+        customer_index = build_customer_index(gocardless_customers_df)
+
+    partition_kwargs = dict(
+        gocardless_customers_df=gocardless_customers_df,
+        customer_index=customer_index,
+        invoice_id_prefix=invoice_id_prefix,
+        invoice_date=invoice_date,
+        invoice_customer_id_field=invoice_customer_id_field,
+        invoice_gocardless_email_field=invoice_gocardless_email_field,
+        invoice_total_amount_field=invoice_total_amount_field,
+        invoice_payment_method_field=invoice_payment_method_field,
+        invoice_payment_method_value=invoice_payment_method_value,
+        item_line_amount_columns=item_line_amount_columns,
+        payment_amount_columns=payment_amount_columns,
+        payment_charge_date_columns=payment_charge_date_columns,
+    )
+
+    # Partitioning a sheet with fewer than 2 invoices only adds the cost of the worker processes
+    if workers > 1 and len(invoice_df) > 1:
+        # Partition by customer id hash, keeping the row position as index to restore the serial order
+        positioned_invoice_df = invoice_df.reset_index(drop=True)
+        partition_ids = pandas.util.hash_pandas_object(
+            positioned_invoice_df[invoice_customer_id_field].astype(str), index=False
+        ) % workers
+        partition_dfs = [partition_df for _, partition_df in positioned_invoice_df.groupby(partition_ids, sort=True)]
+        logger.info(f"Processing {len(invoice_df)} invoices in {len(partition_dfs)} partitions with {workers} workers")
+
+        try:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                partition_results = list(executor.map(
+                    functools.partial(_process_invoice_partition, **partition_kwargs),
+                    partition_dfs,
+                ))
+        except AssertionError:
+            # A partition only reports its own invalid invoices: check all invoices in this process instead,
+            # so that the error lists all of them, as the serial path does
+            logger.info("There are invalid invoices, checking all invoices in a single process")
+            _process_invoice_partition(invoice_df, **partition_kwargs)
+            raise
+
+        # Restore the serial order: by payment column first, then by invoice row position
+        payment_df = pandas.concat([result[0] for result in partition_results], axis=0) \
+            .sort_index(level=[0, 1], sort_remaining=False, kind="stable")
+        cumulated_invoice_amount = sum(result[1] for result in partition_results)
+    else:
+        payment_df, cumulated_invoice_amount = _process_invoice_partition(invoice_df, **partition_kwargs)
+
+    # Check that sum of payments is the same as sum of invoices
+    cumulated_payment_amount = payment_df["payment.amount"].sum()
+
+    assert abs(cumulated_payment_amount - cumulated_invoice_amount) < 0.001, (
+        f"There is a difference between {cumulated_invoice_amount=} and {cumulated_payment_amount=} \n"
+        f"{payment_df=} \n"
+    )
+
+    return payment_df[GOCARDLESS_COLUMNS].reset_index(drop=True)
+
+
+def _process_invoice_partition(
+    invoice_df: pandas.DataFrame,
+    gocardless_customers_df: pandas.DataFrame,
+    customer_index: CustomerEmailIndex,
+    invoice_id_prefix: str,
+    invoice_date: str,
+    invoice_customer_id_field: str,
+    invoice_gocardless_email_field: str,
+    invoice_total_amount_field: str,
+    invoice_payment_method_field: Optional[str],
+    invoice_payment_method_value: Optional[str],
+    item_line_amount_columns: List[str],
+    payment_amount_columns: Dict[str, str],
+    payment_charge_date_columns: Dict[str, str],
+) -> Tuple[pandas.DataFrame, float]:
+    """
+    Validate, join and scatter a partition of invoice requests.
+
+    Returns the payments indexed by (payment column position, invoice row label) and the invoiced total.
+    """
+    invoice_df = invoice_df.copy()
+
+    # Invoice requests: cast amount columns to numeric (amounts scattered from meta rows are categoricals)
+    amount_cols = [invoice_total_amount_field, *item_line_amount_columns, *payment_amount_columns.values()]
+    invoice_df[amount_cols] = invoice_df[amount_cols] \
+        .astype(object) \
+        .replace(r'[^\-\d.]', '', regex=True) \
+        .replace('', 0.0) \
+        .astype(float)
+
+    # Invoice requests: Validate that the sum of item_lines is equal to sum of charge amount and total of invoice
+    invoice_df["unmatched_amounts"] = round(
+        abs(invoice_df[invoice_total_amount_field] - sum(invoice_df[col] for col in item_line_amount_columns)) +
+        abs(invoice_df[invoice_total_amount_field] - sum(invoice_df[col] for col in payment_amount_columns.values())),
+        2
+    )
+
+    invoice_with_sum_difference_df = invoice_df[invoice_df["unmatched_amounts"] > 0]
+    assert len(invoice_with_sum_difference_df) == 0, (
+        f"There are {len(invoice_with_sum_difference_df)} invoices with invalid amounts:\n"
+        f"{invoice_with_sum_difference_df}"
+    )
+
+    # Invoice requests: Check whether there are multiple invoice requests per customer
+    duplicate_customers_idx = invoice_df[invoice_customer_id_field].duplicated()
+    duplicate_customers_df = invoice_df[duplicate_customers_idx]
+    assert duplicate_customers_df.size == 0, (
+        f"There are customers with duplicate invoices:"
+        f"{duplicate_customers_df}"
+    )
+
+    # Invoice requests: Retain only invoices which should be paid with GoCardless
+    if invoice_payment_method_field and invoice_payment_method_value:
+        other_payment_method_invoice_idx = invoice_df[invoice_payment_method_field] != invoice_payment_method_value
+        gocardless_invoice_df = invoice_df[~other_payment_method_invoice_idx]
+        if len(gocardless_invoice_df) < len(invoice_df):
+            other_payment_method_invoice_df = invoice_df[other_payment_method_invoice_idx]
+            logger.warn(
+                f"There are {len(other_payment_method_invoice_df)} invoices with other payment method: \n"
+                f"{other_payment_method_invoice_df[[invoice_customer_id_field, 'payment_method']]}"
+            )
+            logger.info(f"There are {len(gocardless_invoice_df)} invoices with gocardless: \n{gocardless_invoice_df}")
+    else:
+        gocardless_invoice_df = invoice_df
+
+    # Invoice requests: Check that all invoices have positive amounts
+    void_invoice_df = gocardless_invoice_df[gocardless_invoice_df[invoice_total_amount_field] <= 0]
+    if len(void_invoice_df) > 0:
+        assert len(void_invoice_df) == 0, (
+            f"There are {len(void_invoice_df)} void invoices with gocardless setup. "
+            "Please set another payment method and handle these separately\n"
+            f"{void_invoice_df}"
+        )
+
+    # Match GoCardless customers: by email first, then by normalized email if it is not ambiguous
+    customer_matches = gocardless_invoice_df[invoice_gocardless_email_field].map(customer_index.matches)
+    ambiguous_customer_invoice_df = gocardless_invoice_df[customer_matches.map(len) > 1]
+    assert len(ambiguous_customer_invoice_df) == 0, (
+        f"There are {len(ambiguous_customer_invoice_df)} invoices matching several gocardless customers:\n" +
+        "\n".join(
+            _format_ambiguous_customer(customer_index, gocardless_customers_df, customer_id, email)
+            for customer_id, email in ambiguous_customer_invoice_df[
+                [invoice_customer_id_field, invoice_gocardless_email_field]
+            ].itertuples(index=False)
+        )
+    )
+    customer_positions = [matches[0] if matches else -1 for matches in customer_matches]
+
+    # Merge GoCardless customer data, keeping the invoice row labels which the merge would renumber
+    merged_gocardless_invoice_df = pandas.merge(
+        left=gocardless_invoice_df.rename_axis("_invoice_row").reset_index(),
+        left_on=pandas.Series(customer_positions, dtype="int64").values,
+        right=gocardless_customers_df.reset_index(drop=True),
+        right_index=True,
+        how='left',
+    ).set_index("_invoice_row").rename_axis(None)
+
+    # Verify whether any GoCardless customer is missing
+    missing_gocardless_customer_invoice_idx = merged_gocardless_invoice_df["customer.id"].isna()
+    missing_gocardless_customer_invoice_df = merged_gocardless_invoice_df[missing_gocardless_customer_invoice_idx]
+    if len(missing_gocardless_customer_invoice_df) > 0:
+        assert len(missing_gocardless_customer_invoice_df) == 0, (
+            f"There are {len(missing_gocardless_customer_invoice_df)} invoices with missing gocardless account:\n" +
+            "\n".join(
+                _format_missing_customer(customer_index, gocardless_customers_df, customer_id, email)
+                for customer_id, email in missing_gocardless_customer_invoice_df[
+                    [invoice_customer_id_field, invoice_gocardless_email_field]
+                ].itertuples(index=False)
+            )
+        )
+
+    logger.info(
+        f"There are {len(merged_gocardless_invoice_df)} invoices to process with gocardless:"
+        f"{merged_gocardless_invoice_df}"
+    )
+
+    # Invoice requests: Build up invoice id
+    merged_gocardless_invoice_df["payment.metadata.INVOICE_ID"] = \
+        f"{invoice_id_prefix}" + merged_gocardless_invoice_df[invoice_customer_id_field]
+    merged_gocardless_invoice_df["payment.metadata.INVOICE_DATE"] = invoice_date
+
+    # Scatter over payments, only copying the output columns and the columns of each payment:
+    # wide sheets have hundreds of item line and payment columns
+    payment_dfs = []
+    output_columns = [column for column in GOCARDLESS_COLUMNS if column in merged_gocardless_invoice_df.columns]
+
+    for payment_id, payment_amount_column in payment_amount_columns.items():
+        charge_date_column = payment_charge_date_columns[payment_id]
+
+        df = merged_gocardless_invoice_df[[*output_columns, payment_amount_column, charge_date_column]][
+            merged_gocardless_invoice_df[payment_amount_column] > 0.005
+        ].copy()
+        df["payment.description"] = df["payment.metadata.INVOICE_ID"] + f"/{payment_id}"
+        df["payment.charge_date"] = df[charge_date_column].astype(object)
+        df["payment.amount"] = df[payment_amount_column]
+        df["payment.currency"] = "GBP"
+        # Same columns for all payments, so that they are concatenated without aligning columns
+        payment_dfs.append(df.drop(columns=[payment_amount_column, charge_date_column]))
+
+    payment_df = pandas.concat(payment_dfs, axis=0, keys=range(len(payment_dfs)))
+
+    return payment_df, gocardless_invoice_df[invoice_total_amount_field].sum()
+
+
+def _format_missing_customer(
+    customer_index: CustomerEmailIndex,
+    gocardless_customers_df: pandas.DataFrame,
+    customer_id: str,
+    email: str,
+) -> str:
+    """Describe an invoice without GoCardless customer, with the closest customers as suggestions"""
+
+    suggestions = ", ".join(
+        f"{customer['customer.email']} ({customer['customer.id']})"
+        for _, customer in gocardless_customers_df.iloc[customer_index.suggest(email)].iterrows()
+    )
+    return f"  {customer_id} <{email}>: closest customers: {suggestions or 'none'}"
+
+
+def _format_ambiguous_customer(
+    customer_index: CustomerEmailIndex,
+    gocardless_customers_df: pandas.DataFrame,
+    customer_id: str,
+    email: str,
+) -> str:
+    """Describe an invoice matching several GoCardless customers through its normalized email"""
+
+    candidates = ", ".join(
+        f"{customer['customer.email']} ({customer['customer.id']})"
+        for _, customer in gocardless_customers_df.iloc[customer_index.matches(email)].iterrows()
+    )
+    return f"  {customer_id} <{email}>: matches several customers: {candidates}"
@@ -0,0 +1,314 @@
+"""
+Typed, DataFrame-free API to build GoCardless payments, e.g. for a single family's invoice.
+
+`payments_from_rows` gives the same payments as `payments.process_payments`, from rows as dictionaries,
+without the pandas overhead which dominates for small inputs.
+"""
+from dataclasses import dataclass, fields
+import math
+import re
+from typing import Iterable, List, Mapping, Optional
+
+from generate_gocardless_payments_csv.customer_index import CustomerEmailIndex
+from generate_gocardless_payments_csv.columns import GOCARDLESS_COLUMNS, REQUIRED_CUSTOMER_COLUMNS
+from shared.row_utils import ColumnSchema, get_column_schema, process_rows_with_metadata
+
+
+@dataclass(slots=True, frozen=True)
+class GoCardlessCustomer:
+    mandate_id: str
+    customer_id: str
+    given_name: str
+    family_name: str
+    company_name: str
+    email: str
+
+    @classmethod
+    def from_row(cls, row: Mapping) -> "GoCardlessCustomer":
+        """Customer from a row of the GoCardless customer export"""
+        return cls(
+            mandate_id=row["mandate.id"],
+            customer_id=row["customer.id"],
+            given_name=row["customer.given_name"],
+            family_name=row["customer.family_name"],
+            company_name=row["customer.company_name"],
+            email=row["customer.email"],
+        )
+
+
+@dataclass(slots=True, frozen=True)
+class PaymentRequest:
+    payment_id: str
+    amount: float
+    charge_date: str
+
+
+@dataclass(slots=True)
+class InvoiceRequest:
+    customer_id: str
+    gocardless_email: str
+    total_amount: float
+    item_line_amounts: List[float]
+    payments: List[PaymentRequest]
+    payment_method: Optional[str] = None
+
+    @classmethod
+    def from_row(
+        cls,
+        row: Mapping,
+        invoice_customer_id_field: str,
+        invoice_gocardless_email_field: str,
+        invoice_total_amount_field: str,
+        invoice_payment_method_field: Optional[str] = None,
+        schema: Optional[ColumnSchema] = None,
+    ) -> "InvoiceRequest":
+        """
+        Invoice request from a row processed with `process_rows_with_metadata`.
+        Pass the `schema` of the row columns when building many invoice requests.
+        """
+        if schema is None:
+            schema = get_column_schema(row)
+        return cls(
+            customer_id=row[invoice_customer_id_field],
+            gocardless_email=row[invoice_gocardless_email_field],
+            total_amount=parse_amount(row[invoice_total_amount_field]),
+            item_line_amounts=[
+                parse_amount(row[column])
+                for column in schema.indexed_columns("item_lines", "amount", numbered=True).values()
+            ],
+            payments=[
+                PaymentRequest(
+                    payment_id=payment_id,
+                    amount=parse_amount(row[column]),
+                    charge_date=row[schema.column("payments", payment_id, "charge_date")],
+                )
+                for payment_id, column in schema.indexed_columns("payments", "amount", numbered=True).items()
+            ],
+            payment_method=row[invoice_payment_method_field] if invoice_payment_method_field else None,
+        )
+
+    @property
+    def unmatched_amount(self) -> float:
+        """Difference between the total and the sums of the item lines and of the payments"""
+        return _round_cents(
+            abs(self.total_amount - sum(self.item_line_amounts)) +
+            abs(self.total_amount - sum(payment.amount for payment in self.payments))
+        )
+
+
+@dataclass(slots=True, frozen=True)
+class PaymentRow:
+    """A row of the GoCardless payment import CSV"""
+
+    mandate_id: str
+    customer_id: str
+    customer_given_name: str
+    customer_family_name: str
+    customer_company_name: str
+    customer_email: str
+    amount: float
+    currency: str
+    description: str
+    charge_date: str
+    invoice_id: str
+    invoice_date: str
+
+    def as_row(self) -> dict:
+        """Row keyed by the GoCardless CSV columns"""
+        return dict(zip(GOCARDLESS_COLUMNS, (getattr(self, field.name) for field in fields(self))))
+
+
+def parse_amount(value) -> float:
+    """Amount from a CSV value, ignoring currency symbols and thousands separators. Empty values are 0"""
+    if value is None:
+        return math.nan
+    if isinstance(value, str):
+        value = re.sub(r'[^\-\d.]', '', value)
+        if value == '':
+            return 0.0
+    return float(value)
+
+
+def validate_invoice_requests(invoice_requests: List[InvoiceRequest]):
+    """Check the amounts of the invoice requests and that there is only one per customer"""
+
+    invalid_invoice_requests = [invoice for invoice in invoice_requests if invoice.unmatched_amount > 0]
+    assert len(invalid_invoice_requests) == 0, (
+        f"There are {len(invalid_invoice_requests)} invoices with invalid amounts:\n"
+        f"{invalid_invoice_requests}"
+    )
+
+    customer_ids = set()
+    duplicate_invoice_requests = []
+    for invoice in invoice_requests:
+        if invoice.customer_id in customer_ids:
+            duplicate_invoice_requests.append(invoice)
+        customer_ids.add(invoice.customer_id)
+    assert len(duplicate_invoice_requests) == 0, (
+        f"There are customers with duplicate invoices:"
+        f"{duplicate_invoice_requests}"
+    )
+
+
+def build_payment_rows(
+    invoice_requests: List[InvoiceRequest],
+    customers: List[GoCardlessCustomer],
+    invoice_id_prefix: str,
+    invoice_date: str,
+    invoice_payment_method_value: Optional[str] = None,
+) -> List[PaymentRow]:
+    """
+    Join validated invoice requests with the GoCardless customers, by email or else by normalized email,
+    and scatter them over payments: all first payments, then all second payments, etc.
+    """
+
+    # Invoice requests: Retain only invoices which should be paid with GoCardless
+    if invoice_payment_method_value:
+        invoice_requests = [
+            invoice for invoice in invoice_requests if invoice.payment_method == invoice_payment_method_value
+        ]
+
+    void_invoice_requests = [invoice for invoice in invoice_requests if invoice.total_amount <= 0]
+    assert len(void_invoice_requests) == 0, (
+        f"There are {len(void_invoice_requests)} void invoices with gocardless setup. "
+        "Please set another payment method and handle these separately\n"
+        f"{void_invoice_requests}"
+    )
+
+    customer_index = CustomerEmailIndex(
+        (customer.email for customer in customers),
+        identities=[(customer.customer_id, customer.mandate_id) for customer in customers],
+    )
+    customer_matches = [customer_index.matches(invoice.gocardless_email) for invoice in invoice_requests]
+    ambiguous_customer_invoice_requests = [
+        (invoice, matches) for invoice, matches in zip(invoice_requests, customer_matches) if len(matches) > 1
+    ]
+    assert len(ambiguous_customer_invoice_requests) == 0, (
+        f"There are {len(ambiguous_customer_invoice_requests)} invoices matching several gocardless customers:\n" +
+        "\n".join(
+            f"  {invoice.customer_id} <{invoice.gocardless_email}>: matches several customers: " + ", ".join(
+                f"{customers[position].email} ({customers[position].customer_id})" for position in matches
+            )
+            for invoice, matches in ambiguous_customer_invoice_requests
+        )
+    )
+    customer_positions = [matches[0] if matches else None for matches in customer_matches]
+    missing_customer_invoice_requests = [
+        invoice for invoice, position in zip(invoice_requests, customer_positions) if position is None
+    ]
+    assert len(missing_customer_invoice_requests) == 0, (
+        f"There are {len(missing_customer_invoice_requests)} invoices with missing gocardless account:\n" +
+        "\n".join(
+            f"  {invoice.customer_id} <{invoice.gocardless_email}>: closest customers: " + (", ".join(
+                f"{customers[position].email} ({customers[position].customer_id})"
+                for position in customer_index.suggest(invoice.gocardless_email)
+            ) or "none")
+            for invoice in missing_customer_invoice_requests
+        )
+    )
+
+    payment_count = max((len(invoice.payments) for invoice in invoice_requests), default=0)
+    payment_rows = []
+    for payment_position in range(payment_count):
+        for invoice, customer_position in zip(invoice_requests, customer_positions):
+            payment = invoice.payments[payment_position]
+            if not payment.amount > 0.005:
+                continue
+            customer = customers[customer_position]  # type: ignore
+            invoice_id = f"{invoice_id_prefix}{invoice.customer_id}"
+            payment_rows.append(PaymentRow(
+                mandate_id=customer.mandate_id,
+                customer_id=customer.customer_id,
+                customer_given_name=customer.given_name,
+                customer_family_name=customer.family_name,
+                customer_company_name=customer.company_name,
+                customer_email=customer.email,
+                amount=payment.amount,
+                currency="GBP",
+                description=f"{invoice_id}/{payment.payment_id}",
+                charge_date=payment.charge_date,
+                invoice_id=invoice_id,
+                invoice_date=invoice_date,
+            ))
+
+    # Check that sum of payments is the same as sum of invoices
+    cumulated_payment_amount = sum(payment_row.amount for payment_row in payment_rows)
+    cumulated_invoice_amount = sum(invoice.total_amount for invoice in invoice_requests)
+    assert abs(cumulated_payment_amount - cumulated_invoice_amount) < 0.001, (
+        f"There is a difference between {cumulated_invoice_amount=} and {cumulated_payment_amount=}"
+    )
+
+    return payment_rows
+
+
+def payments_from_rows(
+    gocardless_customer_rows: Iterable[Mapping],
+    raw_invoice_rows: Iterable[Mapping],
+    invoice_id_prefix: str,
+    invoice_date: str,
+    invoice_customer_id_field: str,
+    invoice_gocardless_email_field: str,
+    invoice_total_amount_field: str,
+    invoice_payment_method_field: Optional[str],
+    invoice_payment_method_value: Optional[str],
+) -> List[PaymentRow]:
+    """DataFrame-free equivalent of `process_payments`, for rows as dictionaries"""
+
+    customer_rows = list(gocardless_customer_rows)
+    for customer_row in customer_rows:
+        missing_customer_columns = REQUIRED_CUSTOMER_COLUMNS.difference(customer_row)
+        assert len(missing_customer_columns) == 0, (
+            f"Missing required columns from gocardless customer csv: \n"
+            f"{missing_customer_columns}"
+        )
+
+    if bool(invoice_payment_method_field) != bool(invoice_payment_method_value):
+        raise ValueError("--invoice-payment-method-field and --invoice-payment-method-value must be provided together")
+
+    invoice_rows = process_rows_with_metadata(raw_invoice_rows)
+    invoice_columns = invoice_rows[0].keys() if invoice_rows else []
+    required_invoice_columns = {
+        invoice_customer_id_field,
+        invoice_gocardless_email_field,
+        invoice_total_amount_field,
+    }
+    missing_invoice_columns = required_invoice_columns.difference(invoice_columns)
+    assert len(missing_invoice_columns) == 0, (
+        f"Missing required columns from invoice csv: \n"
+        f"{missing_invoice_columns}"
+    )
+    schema = get_column_schema(invoice_columns)
+    assert schema.indexed_columns("item_lines", "amount", numbered=True), (
+        "There must be `item_lines.<number>.amount` columns in the invoice request csv"
+    )
+    assert schema.indexed_columns("payments", "amount", numbered=True), (
+        "There must be `payments.<number>.amount` columns in the invoice request csv"
+    )
+
+    invoice_requests = [
+        InvoiceRequest.from_row(
+            invoice_row,
+            invoice_customer_id_field=invoice_customer_id_field,
+            invoice_gocardless_email_field=invoice_gocardless_email_field,
+            invoice_total_amount_field=invoice_total_amount_field,
+            invoice_payment_method_field=invoice_payment_method_field,
+            schema=schema,
+        )
+        for invoice_row in invoice_rows
+    ]
+    validate_invoice_requests(invoice_requests)
+
+    return build_payment_rows(
+        invoice_requests,
+        [GoCardlessCustomer.from_row(customer_row) for customer_row in customer_rows],
+        invoice_id_prefix=invoice_id_prefix,
+        invoice_date=invoice_date,
+        invoice_payment_method_value=invoice_payment_method_value,
+    )
+
+
+def _round_cents(amount: float) -> float:
+    """Round to cents half to even, as numpy does for the DataFrame engine"""
+    if math.isnan(amount):
+        return amount
+    return round(amount * 100) / 100
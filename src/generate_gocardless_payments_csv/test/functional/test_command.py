@@ -1,4 +1,22 @@
+import pathlib
 import subprocess
+import sys
+
+SRC_DIR = pathlib.Path(__file__).parents[3]
+
+# Runs the entry point with --help and reports the heavy modules imported and the time spent
+STARTUP_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+from generate_gocardless_payments_csv.command import main
+sys.argv = ["generate-gocardless-payments-csv", "--help"]
+try:
+    main()
+except SystemExit:
+    pass
+heavy_modules = sorted({"pandas"}.intersection(sys.modules))
+print(f"{heavy_modules} {time.perf_counter() - start:.3f}", file=sys.stderr)
+"""
 
 
 def test_command_line_outputs_help():
@@ -19,3 +37,17 @@ def test_command_line_fails_with_missing_arguments():
     )
     assert response.returncode > 0
     assert "the following arguments are required" in response.stderr.decode()
+
+
+def test_command_line_help_starts_without_heavy_imports():
+    response = subprocess.run(
+        [sys.executable, "-c", STARTUP_SCRIPT],
+        check=False,
+        capture_output=True,
+        cwd=SRC_DIR,
+    )
+    heavy_modules, startup_seconds = response.stderr.decode().strip().rsplit(" ", 1)
+    assert response.returncode == 0
+    assert heavy_modules == "[]"
+    # Generous bound: importing pandas alone takes several times longer
+    assert float(startup_seconds) < 0.25
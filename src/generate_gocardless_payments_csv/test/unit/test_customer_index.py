@@ -0,0 +1,51 @@
+from generate_gocardless_payments_csv.customer_index import CustomerEmailIndex, normalize_email
+
+
+def test_normalize_email():
+    assert normalize_email("  Marie.Curie@Test.Email ") == "marie.curie@test.email"
+    assert normalize_email("marie+school@test.email") == "marie@test.email"
+    assert normalize_email("Marie.Curie+school@googlemail.com") == "mariecurie@gmail.com"
+    assert normalize_email(float("nan")) == ""
+
+
+def test_customer_email_index_lookup_keeps_last_customer():
+    customer_index = CustomerEmailIndex(
+        [
+            "marie.curie@gmail.com",
+            "pierre@test.email",
+            "MarieCurie@gmail.com",
+        ],
+        identities=["CU1", "CU2", "CU1"],
+    )
+
+    assert customer_index.lookup("marie.curie+invoices@gmail.com") == 2
+    assert customer_index.lookup("Pierre@test.email") == 1
+    assert customer_index.lookup("louis@test.email") is None
+
+
+def test_customer_email_index_prefers_exact_email_over_normalized_email():
+    customer_index = CustomerEmailIndex(
+        [
+            "family+smith@school.org",
+            "family+jones@school.org",
+        ],
+        identities=[("CU1", "MD1"), ("CU2", "MD2")],
+    )
+
+    assert customer_index.lookup(" Family+Smith@school.org") == 0
+    assert customer_index.lookup("family+jones@school.org") == 1
+    # Both customers share the normalized email
+    assert customer_index.matches("family@school.org") == [0, 1]
+    assert customer_index.lookup("family@school.org") is None
+
+
+def test_customer_email_index_suggests_closest_customers():
+    customer_index = CustomerEmailIndex([
+        f"parent{i}@test.email" for i in range(1000)
+    ] + [
+        "spelling_mistake@test.email",
+        "spelling@test.email",
+    ])
+
+    assert customer_index.suggest("speling_mistake@test.email", limit=2) == [1000, 1001]
+    assert customer_index.suggest("zzz@test.email") == []
@@ -1,7 +1,7 @@
 import pandas
 import pytest
 
-from generate_gocardless_payments_csv.command import process_payments
+from generate_gocardless_payments_csv.payments import process_payments
 
 
 def assert_frames_equal(left, right, **kwds):
@@ -149,3 +149,233 @@ def test_process_payments_fails_for_duplicate_parent_email():
             invoice_payment_method_field="payment_method",
             invoice_payment_method_value="gocardless",
         )
+
+
+def test_process_payments_with_workers_matches_serial_output():
+    gocardless_customer_df = pandas.DataFrame([
+        {
+            "customer.company_name": "",
+            "customer.email": f"parent{i}@test.email",
+            "customer.family_name": f"F{i}",
+            "customer.given_name": f"G{i}",
+            "customer.id": f"CU{i}",
+            "mandate.id": f"MD{i}",
+        }
+        for i in range(20)
+    ])
+
+    invoice_df = pandas.DataFrame([
+        # header rows
+        {
+            "meta": "charge_date",
+            "amount_due": "",
+            "gocardless_email": "",
+            "item_lines.1.amount": "",
+            "payments.1.amount": "2023-02-15",
+            "payments.2.amount": "2023-03-15",
+            "parent_id": "",
+        },
+        # invoice request rows
+        *[
+            {
+                "meta": "",
+                "amount_due": f"{10 + i}",
+                "gocardless_email": f"Parent{i}@test.email",
+                "item_lines.1.amount": f"{10 + i}",
+                "payments.1.amount": "10" if i % 3 else f"{10 + i}",
+                "payments.2.amount": f"{i}" if i % 3 else "",
+                "parent_id": f"ID{i}",
+            }
+            for i in range(20)
+        ]
+    ])
+
+    kwds = dict(
+        invoice_id_prefix="INV123/",
+        invoice_date="2023-02-12",
+        invoice_customer_id_field="parent_id",
+        invoice_gocardless_email_field="gocardless_email",
+        invoice_total_amount_field="amount_due",
+        invoice_payment_method_field=None,
+        invoice_payment_method_value=None,
+    )
+
+    serial_payments_df = process_payments(gocardless_customer_df, invoice_df, **kwds)
+    parallel_payments_df = process_payments(gocardless_customer_df, invoice_df, workers=3, **kwds)
+
+    assert len(serial_payments_df) == 20 + 13
+    assert parallel_payments_df.to_csv(index=False) == serial_payments_df.to_csv(index=False)
+    pandas.testing.assert_frame_equal(parallel_payments_df, serial_payments_df)
+
+    # Sheet without invoice requests
+    empty_payments_df = process_payments(gocardless_customer_df, invoice_df.iloc[:1], workers=3, **kwds)
+    assert list(empty_payments_df.columns) == list(serial_payments_df.columns)
+    assert len(empty_payments_df) == 0
+
+    # Invalid invoices of all partitions are reported, as in the serial path
+    invalid_invoice_df = invoice_df.copy()
+    invalid_invoice_df.loc[1:6, "item_lines.1.amount"] = "1"
+    with pytest.raises(AssertionError, match="There are 6 invoices with invalid amounts") as serial_error:
+        process_payments(gocardless_customer_df, invalid_invoice_df, **kwds)
+    with pytest.raises(AssertionError) as parallel_error:
+        process_payments(gocardless_customer_df, invalid_invoice_df, workers=3, **kwds)
+    assert str(parallel_error.value) == str(serial_error.value)
+
+
+def test_process_payments_with_item_line_amounts_from_meta_row():
+    gocardless_customer_df = pandas.DataFrame([{
+        "customer.company_name": "",
+        "customer.email": "m.c@test.email",
+        "customer.family_name": "C",
+        "customer.given_name": "M",
+        "customer.id": "CU1",
+        "mandate.id": "MD1",
+    }])
+
+    invoice_df = pandas.DataFrame([
+        # header rows
+        {
+            "meta": "amount",
+            "amount_due": "",
+            "gocardless_email": "",
+            "item_lines.1.child_name": "100.00",
+            "item_lines.2.child_name": "90.00",
+            "payments.1.amount": "",
+            "parent_id": "",
+        },
+        {
+            "meta": "charge_date",
+            "amount_due": "",
+            "gocardless_email": "",
+            "item_lines.1.child_name": "",
+            "item_lines.2.child_name": "",
+            "payments.1.amount": "2023-02-15",
+            "parent_id": "",
+        },
+        # invoice request row
+        {
+            "meta": "",
+            "amount_due": "100",
+            "gocardless_email": "m.c@test.email",
+            "item_lines.1.child_name": "Irene",
+            "item_lines.2.child_name": "",
+            "payments.1.amount": "100",
+            "parent_id": "ID123",
+        }
+    ])
+
+    payments_df = process_payments(
+        gocardless_customer_df,
+        invoice_df,
+        invoice_id_prefix="INV123/",
+        invoice_date="2023-02-12",
+        invoice_customer_id_field="parent_id",
+        invoice_gocardless_email_field="gocardless_email",
+        invoice_total_amount_field="amount_due",
+        invoice_payment_method_field=None,
+        invoice_payment_method_value=None,
+    )
+
+    assert payments_df["payment.amount"].tolist() == [100.0]
+    assert payments_df["payment.charge_date"].tolist() == ["2023-02-15"]
+    assert payments_df["payment.charge_date"].dtype == object
+
+
+def test_process_payments_fails_for_missing_customer_with_suggestions():
+    gocardless_customer_df = pandas.DataFrame([{
+        "customer.company_name": "",
+        "customer.email": "marie.curie@test.email",
+        "customer.family_name": "C",
+        "customer.given_name": "M",
+        "customer.id": "CU1",
+        "mandate.id": "MD1",
+    }])
+
+    invoice_df = pandas.DataFrame([
+        {
+            "meta": "charge_date",
+            "amount_due": "",
+            "gocardless_email": "",
+            "item_lines.1.amount": "",
+            "payments.1.amount": "2023-02-15",
+            "parent_id": "",
+        },
+        {
+            "meta": "",
+            "amount_due": "12.34",
+            "gocardless_email": "marie.curei@test.email",
+            "item_lines.1.amount": "12.34",
+            "payments.1.amount": "12.34",
+            "parent_id": "ID123",
+        },
+    ])
+
+    with pytest.raises(AssertionError, match=r"ID123 <marie.curei@test.email>: .* marie.curie@test.email \(CU1\)"):
+        process_payments(
+            gocardless_customer_df,
+            invoice_df,
+            invoice_date="2023-02-06",
+            invoice_id_prefix="INV123/",
+            invoice_customer_id_field="parent_id",
+            invoice_gocardless_email_field="gocardless_email",
+            invoice_total_amount_field="amount_due",
+            invoice_payment_method_field=None,
+            invoice_payment_method_value=None,
+        )
+
+
+def test_process_payments_matches_exact_email_before_normalized_email():
+    gocardless_customer_df = pandas.DataFrame([
+        {
+            "customer.company_name": "",
+            "customer.email": f"family+{name}@school.org",
+            "customer.family_name": name.title(),
+            "customer.given_name": "A",
+            "customer.id": f"CU{i}",
+            "mandate.id": f"MD{i}",
+        }
+        for i, name in enumerate(["smith", "jones"], start=1)
+    ])
+
+    def invoice_df(*emails):
+        return pandas.DataFrame([
+            {
+                "meta": "charge_date",
+                "amount_due": "",
+                "gocardless_email": "",
+                "item_lines.1.amount": "",
+                "payments.1.amount": "2023-02-15",
+                "parent_id": "",
+            },
+            *[
+                {
+                    "meta": "",
+                    "amount_due": "10",
+                    "gocardless_email": email,
+                    "item_lines.1.amount": "10",
+                    "payments.1.amount": "10",
+                    "parent_id": f"ID{i}",
+                }
+                for i, email in enumerate(emails)
+            ],
+        ])
+
+    kwds = dict(
+        invoice_date="2023-02-06",
+        invoice_id_prefix="INV123/",
+        invoice_customer_id_field="parent_id",
+        invoice_gocardless_email_field="gocardless_email",
+        invoice_total_amount_field="amount_due",
+        invoice_payment_method_field=None,
+        invoice_payment_method_value=None,
+    )
+
+    payments_df = process_payments(
+        gocardless_customer_df, invoice_df("Family+Smith@school.org", "family+jones@school.org"), **kwds
+    )
+    assert list(payments_df["customer.id"]) == ["CU1", "CU2"]
+    assert list(payments_df["mandate.id"]) == ["MD1", "MD2"]
+
+    ambiguous_message = r"ID0 <family@school.org>: matches several customers: .*\(CU1\), .*\(CU2\)"
+    with pytest.raises(AssertionError, match=ambiguous_message):
+        process_payments(gocardless_customer_df, invoice_df("family@school.org"), **kwds)
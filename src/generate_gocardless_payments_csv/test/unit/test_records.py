@@ -0,0 +1,141 @@
+import pathlib
+import subprocess
+import sys
+
+import pandas
+import pytest
+
+from generate_gocardless_payments_csv.payments import process_payments
+from generate_gocardless_payments_csv.records import InvoiceRequest, parse_amount, payments_from_rows
+
+GOCARDLESS_CUSTOMER_ROWS = [
+    {
+        "customer.company_name": "",
+        "customer.email": f"parent{i}@test.email",
+        "customer.family_name": f"F{i}",
+        "customer.given_name": f"G{i}",
+        "customer.id": f"CU{i}",
+        "mandate.id": f"MD{i}",
+    }
+    for i in range(10)
+]
+
+INVOICE_ROWS = [
+    # header rows
+    {
+        "meta": "charge_date",
+        "amount_due": "",
+        "gocardless_email": "",
+        "item_lines.1.amount": "",
+        "item_lines.2.amount": "",
+        "payments.1.amount": "2023-02-15",
+        "payments.2.amount": "2023-03-15",
+        "parent_id": "",
+        "payment_method": "",
+    },
+    # invoice request rows
+    *[
+        {
+            "meta": "",
+            "amount_due": f"£{10 + i}.50",
+            "gocardless_email": f" Parent{i}@test.email",
+            "item_lines.1.amount": "10",
+            "item_lines.2.amount": f"{i}.50",
+            "payments.1.amount": "10" if i % 3 else f"{10 + i}.50",
+            "payments.2.amount": f"{i}.50" if i % 3 else "",
+            "parent_id": f"ID{i}",
+            "payment_method": "gocardless" if i != 4 else "cash",
+        }
+        for i in range(10)
+    ]
+]
+
+PAYMENT_KWDS = dict(
+    invoice_id_prefix="INV123/",
+    invoice_date="2023-02-12",
+    invoice_customer_id_field="parent_id",
+    invoice_gocardless_email_field="gocardless_email",
+    invoice_total_amount_field="amount_due",
+    invoice_payment_method_field="payment_method",
+    invoice_payment_method_value="gocardless",
+)
+
+
+def test_payments_from_rows_matches_dataframe_engine():
+    payment_rows = payments_from_rows(GOCARDLESS_CUSTOMER_ROWS, INVOICE_ROWS, **PAYMENT_KWDS)
+
+    payments_df = process_payments(
+        pandas.DataFrame(GOCARDLESS_CUSTOMER_ROWS),
+        pandas.DataFrame(INVOICE_ROWS),
+        **PAYMENT_KWDS,
+    )
+
+    assert len(payment_rows) == 9 + 5
+    assert pandas.DataFrame([payment_row.as_row() for payment_row in payment_rows]).to_csv(index=False) == \
+        payments_df.to_csv(index=False)
+
+
+def test_payments_from_rows_fails_for_invalid_amounts():
+    invoice_rows = [dict(row) for row in INVOICE_ROWS]
+    invoice_rows[1]["item_lines.2.amount"] = "1"
+
+    with pytest.raises(AssertionError, match=r"There are 1 invoices with invalid amounts"):
+        payments_from_rows(GOCARDLESS_CUSTOMER_ROWS, invoice_rows, **PAYMENT_KWDS)
+
+
+def test_payments_from_rows_fails_for_ambiguous_normalized_email():
+    customer_rows = [dict(row) for row in GOCARDLESS_CUSTOMER_ROWS]
+    customer_rows[1]["customer.email"] = "parent0+1@test.email"
+    customer_rows[2]["customer.email"] = "parent0+2@test.email"
+    invoice_rows = [dict(row) for row in INVOICE_ROWS]
+    invoice_rows[2]["gocardless_email"] = "parent0+1@test.email"
+    invoice_rows[3]["gocardless_email"] = "parent0+3@test.email"
+
+    with pytest.raises(AssertionError, match=r"ID2 <parent0\+3@test.email>: matches several customers: "):
+        payments_from_rows(customer_rows, invoice_rows, **PAYMENT_KWDS)
+
+    invoice_rows[3]["gocardless_email"] = "parent0+2@test.email"
+    payment_rows = payments_from_rows(customer_rows, invoice_rows, **PAYMENT_KWDS)
+    assert [row.customer_id for row in payment_rows if row.invoice_id in {"INV123/ID1", "INV123/ID2"}] == \
+        ["CU1", "CU2", "CU1", "CU2"]
+
+
+def test_invoice_request_from_row():
+    invoice_request = InvoiceRequest.from_row(
+        {
+            "parent_id": "ID1",
+            "gocardless_email": "m.c@test.email",
+            "amount_due": "£1,012.34",
+            "item_lines.1.amount": "1012.34",
+            "payments.1.amount": "1012.34",
+            "payments.1.charge_date": "2023-02-15",
+        },
+        invoice_customer_id_field="parent_id",
+        invoice_gocardless_email_field="gocardless_email",
+        invoice_total_amount_field="amount_due",
+    )
+
+    assert invoice_request.total_amount == 1012.34
+    assert invoice_request.item_line_amounts == [1012.34]
+    assert [payment.charge_date for payment in invoice_request.payments] == ["2023-02-15"]
+    assert invoice_request.unmatched_amount == 0
+    assert not hasattr(invoice_request, "__dict__")
+
+
+def test_parse_amount():
+    assert parse_amount("£12.30") == 12.3
+    assert parse_amount("") == 0.0
+    assert parse_amount(4.5) == 4.5
+
+
+def test_records_do_not_import_pandas():
+    response = subprocess.run(
+        [
+            sys.executable, "-c",
+            "import sys; import generate_gocardless_payments_csv.records; print('pandas' in sys.modules)",
+        ],
+        check=True,
+        capture_output=True,
+        cwd=pathlib.Path(__file__).parents[3],
+    )
+    assert response.stdout.decode().strip() == "False"
@@ -0,0 +1,63 @@
+import pandas
+
+from generate_gocardless_payments_csv.watch import PaymentsSession
+
+
+def test_payments_session_only_reloads_changed_inputs(tmp_path):
+    customers_path = tmp_path / "customers.csv"
+    invoices_path = tmp_path / "invoices.csv"
+    output_path = tmp_path / "payments.csv"
+
+    pandas.DataFrame([{
+        "customer.company_name": "",
+        "customer.email": "m.c@test.email",
+        "customer.family_name": "C",
+        "customer.given_name": "M",
+        "customer.id": "CU1",
+        "mandate.id": "MD1",
+    }]).to_csv(customers_path, index=False)
+
+    def write_invoices(amount):
+        pandas.DataFrame([
+            {
+                "meta": "charge_date",
+                "amount_due": "",
+                "gocardless_email": "",
+                "item_lines.1.amount": "",
+                "payments.1.amount": "2023-02-15",
+                "parent_id": "",
+            },
+            {
+                "meta": "",
+                "amount_due": amount,
+                "gocardless_email": "m.c@test.email",
+                "item_lines.1.amount": amount,
+                "payments.1.amount": amount,
+                "parent_id": "ID1",
+            },
+        ]).to_csv(invoices_path, index=False)
+
+    session = PaymentsSession(
+        gocardless_payment_template_csv=customers_path,
+        invoice_requests_csv=invoices_path,
+        output_gocardless_payments_csv=output_path,
+        invoice_id_prefix="INV123/",
+        invoice_date="2023-02-12",
+        invoice_customer_id_field="parent_id",
+        invoice_gocardless_email_field="gocardless_email",
+        invoice_total_amount_field="amount_due",
+        invoice_payment_method_field=None,
+        invoice_payment_method_value=None,
+    )
+
+    write_invoices("10")
+    session.run(session.input_paths)
+    gocardless_customers_df = session.gocardless_customers_df
+    customer_index = session.customer_index
+    assert list(pandas.read_csv(output_path)["payment.amount"]) == [10.0]
+
+    write_invoices("12.5")
+    session.run([str(invoices_path)])
+    assert session.gocardless_customers_df is gocardless_customers_df
+    assert session.customer_index is customer_index
+    assert list(pandas.read_csv(output_path)["payment.amount"]) == [12.5]
@@ -0,0 +1,79 @@
+"""
+Keep the GoCardless customers and invoice requests in memory, re-running only the stages whose input changed
+"""
+import logging
+from typing import Iterable, Optional
+
+import pandas
+
+from generate_gocardless_payments_csv.customer_index import CustomerEmailIndex
+from generate_gocardless_payments_csv.payments import (
+    build_customer_index,
+    prepare_gocardless_customers,
+    process_prepared_payments,
+)
+from shared.csv_utils import process_csv_with_metadata
+
+logger = logging.getLogger(__name__)
+
+
+class PaymentsSession:
+    """
+    Generates the GoCardless payments CSV from input files, caching each stage between runs:
+
+    - customers: the GoCardless customer export, read and deduplicated, and its email index,
+    - invoices: the invoice requests, read and processed with their meta rows,
+    - payments: joined and written whenever either stage changed.
+
+    Only the stages reading a changed file are re-run: editing the invoice requests does not re-read the
+    customer export, and the interpreter, pandas and the customers stay warm across runs.
+    """
+
+    def __init__(
+        self,
+        gocardless_payment_template_csv: str,
+        invoice_requests_csv: str,
+        output_gocardless_payments_csv: str,
+        **payment_options,
+    ):
+        self.gocardless_payment_template_csv = str(gocardless_payment_template_csv)
+        self.invoice_requests_csv = str(invoice_requests_csv)
+        self.output_gocardless_payments_csv = output_gocardless_payments_csv
+        self.payment_options = payment_options
+        self.gocardless_customers_df: Optional[pandas.DataFrame] = None
+        self.customer_index: Optional[CustomerEmailIndex] = None
+        self.invoice_df: Optional[pandas.DataFrame] = None
+
+    @property
+    def input_paths(self):
+        return [self.gocardless_payment_template_csv, self.invoice_requests_csv]
+
+    def run(self, changed_paths: Iterable[str]) -> pandas.DataFrame:
+        """Re-run the stages depending on `changed_paths` (or not run yet), and write the payments"""
+
+        changed_paths = set(changed_paths)
+
+        if self.gocardless_customers_df is None or self.gocardless_payment_template_csv in changed_paths:
+            # Cleared first, so that a failed stage is re-run on the next change of any file
+            self.gocardless_customers_df = self.customer_index = None
+            gocardless_customers_df = prepare_gocardless_customers(
+                pandas.read_csv(self.gocardless_payment_template_csv)
+            )
+            self.customer_index = build_customer_index(gocardless_customers_df)
+            self.gocardless_customers_df = gocardless_customers_df
+            logger.info(f"loaded {len(self.gocardless_customers_df)} customers")
+
+        if self.invoice_df is None or self.invoice_requests_csv in changed_paths:
+            self.invoice_df = None
+            self.invoice_df = process_csv_with_metadata(pandas.read_csv(self.invoice_requests_csv))
+            logger.info(f"loaded {len(self.invoice_df)} invoice requests")
+
+        payments_df = process_prepared_payments(
+            gocardless_customers_df=self.gocardless_customers_df,
+            invoice_df=self.invoice_df,
+            customer_index=self.customer_index,
+            **self.payment_options,
+        )
+        payments_df.to_csv(self.output_gocardless_payments_csv, index=False)
+        logger.warning(f"Generated {self.output_gocardless_payments_csv} with {len(payments_df)} payments")
+        return payments_df
@@ -3,27 +3,36 @@ Send templated HTML emails with pdf attachments templated from HTML
 """
 import argparse
 from datetime import date
-from distutils.dir_util import copy_tree
-import io
 import logging
 import os
-from tempfile import TemporaryDirectory
-from jinja2 import Environment, FileSystemLoader, select_autoescape
-import pandas
-import pdfkit  # type: ignore
-from send_mail_with_attachment.mail import get_smtp_server, prepare_message
-from shared.csv_utils import expand_record_lists, process_csv_with_metadata
-
-SMTP_HOST = os.environ['SMTP_HOST']
-SMTP_PORT = os.environ['SMTP_PORT']
-SMTP_USER = os.environ['SMTP_USERNAME']
-SMTP_PASSWORD = os.environ['SMTP_PASSWORD']
-
-logging.basicConfig(level=logging.DEBUG)
-stream = io.StringIO()
+import time
+from typing import Optional
+from send_mail_with_attachment.preview import estimate_sendout, format_estimate, sample_positions
+from shared.log_utils import configure_logging, log_record_status
+
 logger = logging.getLogger()
-handler = logging.StreamHandler(stream)
-logger.addHandler(handler)
+
+# See send_mail_with_attachment.transport, not imported here as it loads the SMTP and SSL modules
+TRANSPORTS = ["smtp-ssl", "smtp-starttls", "smtp", "maildir"]
+
+# wkhtmltopdf options per attachment profile: "print" keeps the historical 400 dpi rendering,
+# the other profiles downsample embedded images and lower the jpeg quality to shrink the pdfs
+PDF_PROFILES = {
+    "print": {
+        "dpi": 400,
+    },
+    "standard": {
+        "dpi": 300,
+        "image-dpi": 300,
+        "image-quality": 90,
+    },
+    "compact": {
+        "dpi": 150,
+        "image-dpi": 150,
+        "image-quality": 75,
+        "lowquality": None,
+    },
+}
 
 
 def parse_args():
@@ -50,8 +59,8 @@ def parse_args():
 
     parser.add_argument(
         '--email-sender',
-        help="email sender",
-        default=SMTP_USER
+        help="email sender (defaults to SMTP_USERNAME, required when it is not set)",
+        default=None
     )
 
     parser.add_argument(
@@ -82,11 +91,123 @@ def parse_args():
         help='attachment file prefix', required=True
     )
 
+    parser.add_argument(
+        '--attachment-profile',
+        help="attachment pdf profile, trading rendering quality for file size",
+        choices=PDF_PROFILES.keys(),
+        default="print",
+    )
+
+    parser.add_argument(
+        '--attachment-dpi',
+        help="attachment pdf dpi (overrides the profile)",
+        type=int,
+        default=None,
+    )
+
+    parser.add_argument(
+        '--attachment-image-dpi',
+        help="dpi to downsample the attachment images to (overrides the profile)",
+        type=int,
+        default=None,
+    )
+
+    parser.add_argument(
+        '--attachment-image-quality',
+        help="jpeg quality of the attachment images, between 0 and 100 (overrides the profile)",
+        type=int,
+        default=None,
+    )
+
     parser.add_argument(
         '--output-dir', required=True,
         help="path to write all output"
     )
 
+    parser.add_argument(
+        '--output-dir-fanout',
+        help="spread the attachments in subdirectories named after the first characters of a hash of their id: "
+        "1 for 16 subdirectories, 2 for 256, etc. (0 writes all attachments in the output dir)",
+        type=int,
+        default=0,
+    )
+
+    parser.add_argument(
+        '--resume',
+        help="reuse the attachments already rendered in the output dir by a previous run",
+        action='store_true'
+    )
+
+    parser.add_argument(
+        '--preview',
+        help="render the templates for all records with strict undefined variable checks, "
+        "render pdfs for a sample only and estimate the cost of the send-out, without sending anything",
+        action='store_true'
+    )
+
+    parser.add_argument(
+        '--preview-sample-size',
+        help="number of records to render pdfs for in --preview mode",
+        type=int,
+        default=10,
+    )
+
+    parser.add_argument(
+        '--watch',
+        help="keep running: preview (or dry run, without --force) the send-out again whenever the input csv or "
+        "a template changes, keeping the records and the compiled templates in memory (stop with Ctrl-C)",
+        action='store_true'
+    )
+
+    parser.add_argument(
+        '--watch-interval',
+        help="seconds between two checks of the input csv and templates in --watch mode",
+        type=float,
+        default=1.0,
+    )
+
+    parser.add_argument(
+        '--transport',
+        help="how to send emails: SMTP over SSL, SMTP upgraded with STARTTLS, plain SMTP, "
+        "or delivery to a local maildir",
+        choices=TRANSPORTS,
+        default="smtp-ssl",
+    )
+
+    parser.add_argument(
+        '--maildir',
+        help="path of the maildir to deliver emails to with --transport maildir",
+        default=None,
+    )
+
+    parser.add_argument(
+        '--max-messages-per-second',
+        help="overall send rate limit (unlimited by default)",
+        type=float,
+        default=None,
+    )
+
+    parser.add_argument(
+        '--max-domain-messages-per-minute',
+        help="send rate limit per recipient domain, e.g. gmail.com (unlimited by default)",
+        type=float,
+        default=None,
+    )
+
+    parser.add_argument(
+        '--max-send-retries',
+        help="number of retries of a message after a temporary (4xx) SMTP error",
+        type=int,
+        default=3,
+    )
+
+    parser.add_argument(
+        '--send-retry-delay',
+        help="seconds to wait before retrying a recipient domain after a temporary SMTP error, doubled on each retry",
+        type=float,
+        default=60.0,
+    )
+
     parser.add_argument(
         '--force',
         help="use this flag to actually send out emails",
@@ -101,55 +222,160 @@ def main():
 
     args = parse_args()
 
-    smtp_server = get_smtp_server(
-        SMTP_HOST,
-        SMTP_PORT,
-        SMTP_USER,
-        SMTP_PASSWORD,
-    )
-    id_field = args.id_field
-    email_field = args.email_field
-    email_subject = args.email_subject
-    email_sender = args.email_sender
-    email_reply_to = args.email_reply_to
-    attachment_file_prefix = args.attachment_file_prefix
+    if args.preview and args.force:
+        raise ValueError("--preview and --force cannot be used together")
+    if args.watch and args.force:
+        raise ValueError("--watch and --force cannot be used together: watched send-outs are only previewed or dry run")
+
+    # Checked before rendering: the emails and the report are sent from this address
+    email_sender = args.email_sender or os.environ.get('SMTP_USERNAME')
+    if not email_sender and not args.preview:
+        raise ValueError("--email-sender is required when SMTP_USERNAME is not set (e.g. with --transport maildir)")
+
+    if args.watch:
+        return watch_sendout(args, email_sender)
+
+    # The full log is spilled to disk to be attached to the report, which is not sent when previewing
+    run_log = configure_logging(spill=not args.preview)
+
+    invoice_df, columns, constant_record = load_records(args)
+    renderer = create_renderer(args, columns, constant_record)
+    sendout(args, run_log, email_sender, invoice_df, renderer)
+
+
+def watch_sendout(args, email_sender: Optional[str]):
+    """Preview or dry run the send-out on each change of its input files, keeping unchanged inputs in memory"""
+
+    from send_mail_with_attachment.watch import SendoutSession
+    from shared.watch import INPUT_ERRORS, FileWatcher, watch
+    from jinja2 import TemplateError
+
+    # Each run captures its own log, for its report (see SendoutSession)
+    logging.basicConfig(level=logging.DEBUG)
+
+    session = SendoutSession(args, email_sender)
+    logger.warning(f"Watching {session.input_paths}")
+    try:
+        watch(
+            FileWatcher(session.input_paths),
+            session.run,
+            interval=args.watch_interval,
+            input_errors=(*INPUT_ERRORS, TemplateError),
+        )
+    except KeyboardInterrupt:
+        logger.warning("Stopped watching")
+
+
+def load_records(args):
+    """
+    Records of the input request CSV, processed with their meta rows, without the values shared by all records.
+
+    Returns the records, the input columns and the values shared by all records.
+    """
+
+    # Imported here so that the argument parsing does not pay for the pandas import
+    import pandas
+    from shared.csv_utils import process_csv_with_metadata, split_constant_columns
 
     raw_invoice_df = pandas.read_csv(args.input_request_csv)
     invoice_df = process_csv_with_metadata(input_df=raw_invoice_df)
 
-    if id_field not in invoice_df.columns:
+    if args.id_field not in invoice_df.columns:
         raise ValueError(
             f"{invoice_df.columns=} must contain --id-field ({args.id_field})")
-    if email_field not in invoice_df.columns:
+    if args.email_field not in invoice_df.columns:
         raise ValueError(
-            f"{invoice_df.columns=} must contain --email-field ({email_field})"
+            f"{invoice_df.columns=} must contain --email-field ({args.email_field})"
         )
 
-    email_jinja_env = Environment(
-        loader=FileSystemLoader(os.path.dirname(
-            args.input_email_template_html)),
-        autoescape=select_autoescape()
+    # Values shared by all records (e.g. scattered from the meta rows) are computed once for the templates
+    columns = list(invoice_df.columns)
+    invoice_df, constant_record = split_constant_columns(invoice_df, keep_columns=[args.id_field, args.email_field])
+    return invoice_df, columns, constant_record
+
+
+def get_global_context(args, constant_record: dict) -> dict:
+    """Template context shared by all records"""
+
+    return {
+        **constant_record,
+        "today": date.today().strftime("%d/%m/%Y"),
+        "attachment_file_prefix": args.attachment_file_prefix,
+    }
+
+
+def create_renderer(args, columns, constant_record: dict):
+    """Renderer of the email and attachment templates, see `load_records`"""
+
+    from jinja2 import StrictUndefined, Undefined
+    from send_mail_with_attachment.render import RecordRenderer
+
+    return RecordRenderer(
+        args.input_email_template_html,
+        args.input_attachment_template_html,
+        columns=columns,
+        global_context=get_global_context(args, constant_record),
+        # Undefined variables are rendered empty, unless previewing
+        undefined=StrictUndefined if args.preview else Undefined,
     )
-    email_template = email_jinja_env.get_template(
-        os.path.basename(args.input_email_template_html))
 
-    attachment_jinja_env = Environment(
-        loader=FileSystemLoader(os.path.dirname(
-            args.input_attachment_template_html)),
-        autoescape=select_autoescape()
+
+def sendout(args, run_log, email_sender: Optional[str], invoice_df, renderer):
+    """Render the records loaded with `load_records`, then preview, dry run or send them and report"""
+
+    # Imported here so that the argument parsing does not pay for the jinja2, pdfkit and email imports
+    from contextlib import ExitStack
+    from distutils.dir_util import copy_tree
+    from html import escape
+    from tempfile import TemporaryDirectory, TemporaryFile
+    from zipfile import ZIP_DEFLATED, ZipFile
+    from jinja2 import UndefinedError
+    import pdfkit  # type: ignore
+    from send_mail_with_attachment.mail import prepare_message, write_message
+    from send_mail_with_attachment.output import OutputManager, input_digest
+    from send_mail_with_attachment.schedule import SendScheduler
+    from send_mail_with_attachment.transport import get_transport
+
+    # The SMTP settings are only required to actually send, not to preview
+    if not args.preview:
+        smtp_settings = get_smtp_settings(args.transport)
+        transport = get_transport(args.transport, maildir=args.maildir, **smtp_settings)
+    id_field = args.id_field
+    email_field = args.email_field
+    email_subject = args.email_subject
+    email_reply_to = args.email_reply_to
+    attachment_file_prefix = args.attachment_file_prefix
+    pdf_options = get_pdf_options(
+        args.attachment_profile,
+        dpi=args.attachment_dpi,
+        image_dpi=args.attachment_image_dpi,
+        image_quality=args.attachment_image_quality,
     )
-    attachment_template = attachment_jinja_env.get_template(
-        os.path.basename(args.input_attachment_template_html))
 
     output_dir = os.path.realpath(args.output_dir)
-    attachment_pdf_paths = []
+    archive_path = f'{output_dir}/{attachment_file_prefix}sendout.zip'
+    log_path = f'{output_dir}/{attachment_file_prefix}sendout.log.gz'
+    output = OutputManager(output_dir, attachment_file_prefix, fanout=args.output_dir_fanout)
+    output.check_ids(invoice_df[id_field].astype(str))
+
+    # Preview: pdfs are only rendered for a sample of the records
+    preview_positions = set(sample_positions(len(invoice_df), args.preview_sample_size))
+    template_render_seconds = 0.0
+    email_html_bytes = []
+    sample_pdf_seconds = []
+    sample_pdf_bytes = []
+    undefined_errors = []
 
     messages = []
-    with TemporaryDirectory(prefix="py-charity-utils_") as tmp_dir_path:
+    with TemporaryDirectory(prefix="py-charity-utils_") as tmp_dir_path, ExitStack() as archive_stack:
+        # The archive replaces the previous one only once a send-out completes, and is not written in preview
+        if not args.preview:
+            tmp_archive_path = archive_stack.enter_context(output.atomic_path(archive_path))
+            archive = archive_stack.enter_context(ZipFile(tmp_archive_path, 'w', compression=ZIP_DEFLATED))
         copy_tree(os.path.dirname(
             args.input_attachment_template_html), tmp_dir_path)
 
-        for (i, record) in invoice_df.iterrows():
+        for (position, (i, record)) in enumerate(invoice_df.iterrows()):
             id = str(record[id_field])
             recipient_email = record[email_field]
 
@@ -159,65 +385,182 @@ def main():
                 raise ValueError(f"{record=} must contain an {email_field}")
 
             attachment_html_path = f'{tmp_dir_path}/{attachment_file_prefix}{id}.html'
-            attachment_pdf_path = f'{output_dir}/{attachment_file_prefix}{id}.pdf'
-
-            structured_record = expand_record_lists(record)
-            structured_record["today"] = date.today().strftime("%d/%m/%Y")
-            structured_record["attachment_file_prefix"] = attachment_file_prefix
-            email_html = email_template.render(**structured_record)
-            attachment_html = attachment_template.render(**structured_record)
-            with open(attachment_html_path, 'w', encoding="utf-8") as attachment_file:
-                attachment_file.write(attachment_html)
-
-            pdfkit.from_file(attachment_html_path, attachment_pdf_path, options={
-                "enable-local-file-access": None,
-                "disable-smart-shrinking": '',
-                'page-size': 'A4',
-                'dpi': 400,
-            })
-
-            attachment_pdf_paths.append(attachment_pdf_path)
-
-            logging.info(
-                "written %s bytes at %s", os.path.getsize(attachment_pdf_path), attachment_pdf_path)
-
-            messages.append((recipient_email, email_subject, email_html, attachment_pdf_path))
-
-        log_prefix = "skipped"
+            # Preview: the sample pdfs are only written to the temporary directory, not to the output dir
+            if args.preview:
+                attachment_pdf_path = f'{tmp_dir_path}/{attachment_file_prefix}{id}.pdf'
+            else:
+                attachment_pdf_path = output.path(id, "pdf")
+
+            render_start = time.perf_counter()
+            try:
+                context = renderer.record_context(record)
+                email_html = renderer.render_email(context)
+                renderer.render_attachment(context, attachment_html_path)
+            except UndefinedError as error:
+                if not args.preview:
+                    raise
+                undefined_errors.append(f"{id_field}={id}: {error.message}")
+                continue
+            template_render_seconds += time.perf_counter() - render_start
+
+            if args.preview:
+                email_html_bytes.append(len(email_html.encode("utf-8")))
+                if position not in preview_positions:
+                    continue
+
+            # The pdf is reused if it was rendered from the same html and options, by a previous run
+            attachment_digest = input_digest(attachment_html_path, pdf_options)
+            if args.resume and not args.preview and output.is_current(attachment_pdf_path, attachment_digest):
+                logging.info("reusing %s", attachment_pdf_path)
+            else:
+                pdf_start = time.perf_counter()
+                with output.atomic_path(attachment_pdf_path) as tmp_pdf_path:
+                    pdfkit.from_file(attachment_html_path, tmp_pdf_path, options=pdf_options)
+                if not args.preview:
+                    output.write_digest(attachment_pdf_path, attachment_digest)
+                if args.preview:
+                    sample_pdf_seconds.append(time.perf_counter() - pdf_start)
+                    sample_pdf_bytes.append(os.path.getsize(attachment_pdf_path))
+
+                logging.info(
+                    "written %s bytes at %s", os.path.getsize(attachment_pdf_path), attachment_pdf_path)
+
+            # Preview: nothing is archived or sent
+            if args.preview:
+                continue
+
+            # Archive each email and attachment as soon as it is rendered
+            archive.writestr(f'emails/{attachment_file_prefix}{id}.html', email_html)
+            archive.write(attachment_pdf_path, os.path.basename(attachment_pdf_path))
+
+            messages.append((id, recipient_email, email_subject, email_html, attachment_pdf_path))
+            log_record_status(logger, id, "rendered")
+
+        if args.preview:
+            logging.warning(format_estimate(estimate_sendout(
+                record_count=len(invoice_df),
+                template_render_seconds=template_render_seconds,
+                email_html_bytes=email_html_bytes,
+                sample_pdf_seconds=sample_pdf_seconds,
+                sample_pdf_bytes=sample_pdf_bytes,
+            )))
+            if undefined_errors:
+                raise ValueError(
+                    f"There are {len(undefined_errors)} records with undefined template variables:\n" +
+                    "\n".join(undefined_errors)
+                )
+            return
+
+        def send(message_fields):
+            (id, recipient_email, email_subject, email_html, attachment_pdf_path) = message_fields
+            logging.info(f"sending email to {recipient_email}: {os.path.basename(attachment_pdf_path)}")
+            message = prepare_message(
+                email_sender,
+                recipient_email,
+                email_reply_to,
+                email_subject,
+                email_html,
+                [
+                    attachment_pdf_path,
+                ],
+            )
+            transport.send_message(message)
+            log_record_status(logger, id, "sent", recipient_email)
+
+        # Send all emails, interleaving recipient domains
         if args.force:
-            log_prefix = ""
-
-        # Send all emails
-        for (recipient_email, email_subject, email_html, attachment_pdf_path) in messages:
-            logging.info(f"{log_prefix} sending email to {recipient_email}: {os.path.basename(attachment_pdf_path)}")
-            if args.force:
-                message = prepare_message(
-                    email_sender,
-                    recipient_email,
-                    email_reply_to,
-                    email_subject,
-                    email_html,
-                    [
-                        attachment_pdf_path,
-                    ],
+            scheduler = SendScheduler(
+                messages_per_second=args.max_messages_per_second,
+                domain_messages_per_minute=args.max_domain_messages_per_minute,
+                max_retries=args.max_send_retries,
+                retry_delay=args.send_retry_delay,
+            )
+            scheduler.run(((message_fields[1], message_fields) for message_fields in messages), send)
+        else:
+            for (id, recipient_email, email_subject, email_html, attachment_pdf_path) in messages:
+                log_record_status(
+                    logger, id, "skipped", f"{recipient_email}: {os.path.basename(attachment_pdf_path)}"
                 )
-                smtp_server.send_message(message)
 
     logging.info(f"successfully sent {len(messages)} messages")
 
-    report_message = prepare_message(
-        email_sender,
-        email_sender,
-        email_reply_to,
-        f"Email sendout report: {email_subject}",
-        f"Last email sent:"
-        f"<hr>{email_html}<hr>"
-        f"Send-out log: <pre>{stream.getvalue()}</pre>",
-        attachment_pdf_paths,
-    )
+    # The report embeds a summary of the log, and attaches the full log
+    with output.atomic_path(log_path) as tmp_log_path:
+        run_log.write_compressed(tmp_log_path)
+
+    # Spool the report to disk: the archive and the log are streamed rather than held in memory
+    with TemporaryFile(prefix="py-charity-utils_report_") as spool_file:
+        write_message(
+            spool_file,
+            email_sender,
+            email_sender,
+            email_reply_to,
+            f"Email sendout report: {email_subject}",
+            [
+                "Last email sent:",
+                f"<hr>{email_html}<hr>",
+                "Send-out log summary (full log attached): <pre>",
+                escape(run_log.summary()),
+                "</pre>",
+            ],
+            [
+                archive_path,
+                log_path,
+            ],
+        )
+        spool_file.seek(0)
+        transport.send_spooled_message(email_sender, email_sender, spool_file)
 
     logging.info(f"successfully sent report to {email_sender}")
 
-    smtp_server.send_message(report_message)
-
-    smtp_server.quit()
+    transport.close()
+
+
+def get_smtp_settings(transport: str) -> dict:
+    """
+    SMTP settings from the SMTP_* environment variables, for a transport.
+
+    The maildir transport does not use them, and the plain "smtp" transport does not require a login.
+    """
+
+    if transport == "maildir":
+        return {}
+
+    required_variables = ['SMTP_HOST', 'SMTP_PORT']
+    if transport != "smtp":
+        required_variables += ['SMTP_USERNAME', 'SMTP_PASSWORD']
+    missing_variables = [variable for variable in required_variables if variable not in os.environ]
+    if missing_variables:
+        raise ValueError(f"Missing required environment variables: {missing_variables}")
+
+    return {
+        "host": os.environ['SMTP_HOST'],
+        "port": int(os.environ['SMTP_PORT']),
+        "user": os.environ.get('SMTP_USERNAME'),
+        "password": os.environ.get('SMTP_PASSWORD'),
+    }
+
+
+def get_pdf_options(
+    profile: str,
+    dpi: int | None = None,
+    image_dpi: int | None = None,
+    image_quality: int | None = None,
+) -> dict:
+    """wkhtmltopdf options for an attachment profile, with optional overrides"""
+
+    options: dict = {
+        "enable-local-file-access": None,
+        "disable-smart-shrinking": '',
+        'page-size': 'A4',
+        **PDF_PROFILES[profile],
+    }
+    if dpi is not None:
+        options["dpi"] = dpi
+    if image_dpi is not None:
+        options["image-dpi"] = image_dpi
+    if image_quality is not None:
+        if not 0 <= image_quality <= 100:
+            raise ValueError(f"{image_quality=} must be between 0 and 100")
+        options["image-quality"] = image_quality
+    return options
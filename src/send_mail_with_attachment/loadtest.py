@@ -0,0 +1,164 @@
+"""
+Load test the send-out: render and send emails with attachments for synthetic recipients,
+through an in-process SMTP server or a maildir, and measure the sustained messages per second
+"""
+import argparse
+from datetime import date
+import logging
+import os
+from tempfile import TemporaryDirectory
+import time
+from typing import Iterator, Optional
+
+from send_mail_with_attachment.local_smtp_server import LocalSMTPServer
+from send_mail_with_attachment.mail import prepare_message
+from send_mail_with_attachment.render import RecordRenderer
+from send_mail_with_attachment.schedule import SendScheduler
+from send_mail_with_attachment.transport import MaildirTransport, SMTPTransport
+
+logger = logging.getLogger(__name__)
+
+EMAIL_TEMPLATE = """<html><body>
+<p>Dear {{ name }},</p>
+<p>Please find your invoice {{ id }} of {{ today }} in attachment</p>
+</body></html>"""
+
+ATTACHMENT_TEMPLATE = """<html><body>
+<h1>Invoice {{ id }}</h1>
+<table>
+{% for _k, item_line in item_lines.items() -%}
+<tr><td>{{ item_line.title }}</td><td>&pound;{{ item_line.amount }}</td></tr>
+{% endfor -%}
+</table>
+<p>Total: &pound;{{ amount_due }}</p>
+</body></html>"""
+
+# Recipients are spread over a few domains, as parents sharing providers
+DOMAINS = ["gmail.com", "outlook.com", "yahoo.co.uk", "test.email"]
+
+
+def synthetic_records(recipient_count: int) -> Iterator[dict]:
+    for i in range(recipient_count):
+        yield {
+            "id": f"ID{i}",
+            "name": f"Parent {i}",
+            "email": f"parent{i}@{DOMAINS[i % len(DOMAINS)]}",
+            "item_lines.1.amount": 100.0 + i % 50,
+            "item_lines.2.amount": 23.45,
+            "amount_due": 123.45 + i % 50,
+        }
+
+
+def run_load_test(recipient_count: int, work_dir: str, transport, pdf_options: Optional[dict] = None) -> dict:
+    """
+    Render and send emails for `recipient_count` synthetic recipients.
+
+    The attachments are the rendered HTML, or pdfs when `pdf_options` are given (requires wkhtmltopdf).
+    """
+
+    email_template_path = os.path.join(work_dir, "email.html")
+    attachment_template_path = os.path.join(work_dir, "invoice.html")
+    with open(email_template_path, "w", encoding="utf-8") as template_file:
+        template_file.write(EMAIL_TEMPLATE)
+    with open(attachment_template_path, "w", encoding="utf-8") as template_file:
+        template_file.write(ATTACHMENT_TEMPLATE)
+
+    renderer = RecordRenderer(
+        email_template_path,
+        attachment_template_path,
+        columns=next(synthetic_records(1)).keys(),
+        global_context={
+            "today": date.today().strftime("%d/%m/%Y"),
+            "item_lines.1.title": "Language lessons",
+            "item_lines.2.title": "Membership",
+        },
+    )
+
+    render_start = time.perf_counter()
+    messages = []
+    for record in synthetic_records(recipient_count):
+        context = renderer.record_context(record)
+        email_html = renderer.render_email(context)
+        attachment_path = os.path.join(work_dir, f"invoice-{record['id']}.html")
+        renderer.render_attachment(context, attachment_path)
+        if pdf_options is not None:
+            import pdfkit  # type: ignore
+            pdf_path = os.path.join(work_dir, f"invoice-{record['id']}.pdf")
+            pdfkit.from_file(attachment_path, pdf_path, options=pdf_options)
+            attachment_path = pdf_path
+        messages.append((record["email"], (record["email"], email_html, attachment_path)))
+    render_seconds = time.perf_counter() - render_start
+
+    def send(message_fields):
+        (recipient_email, email_html, attachment_path) = message_fields
+        transport.send_message(prepare_message(
+            "sender@test.email",
+            recipient_email,
+            None,
+            "Load test",
+            email_html,
+            [attachment_path],
+        ))
+
+    send_start = time.perf_counter()
+    sent_count = SendScheduler().run(messages, send)
+    send_seconds = time.perf_counter() - send_start
+    transport.close()
+
+    return {
+        "recipients": recipient_count,
+        "sent": sent_count,
+        "render_seconds": render_seconds,
+        "send_seconds": send_seconds,
+        "render_per_second": recipient_count / render_seconds if render_seconds else float("inf"),
+        "send_per_second": sent_count / send_seconds if send_seconds else float("inf"),
+    }
+
+
+def parse_args():
+    """parse args"""
+    parser = argparse.ArgumentParser(description=__doc__)
+
+    parser.add_argument(
+        '--recipients',
+        help="number of synthetic recipients",
+        type=int,
+        default=2000,
+    )
+
+    parser.add_argument(
+        '--with-pdf',
+        help="render pdf attachments with wkhtmltopdf, rather than attaching the rendered HTML",
+        action='store_true'
+    )
+
+    parser.add_argument(
+        '--maildir',
+        help="deliver to this maildir, rather than to an in-process SMTP server",
+        default=None,
+    )
+
+    return parser.parse_args()
+
+
+def main():
+    """main"""
+
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO)
+    pdf_options = {"enable-local-file-access": None, "page-size": "A4"} if args.with_pdf else None
+
+    with TemporaryDirectory(prefix="py-charity-utils_loadtest_") as work_dir:
+        if args.maildir:
+            result = run_load_test(args.recipients, work_dir, MaildirTransport(args.maildir), pdf_options)
+        else:
+            with LocalSMTPServer() as server:
+                transport = SMTPTransport("127.0.0.1", server.port, security="smtp")
+                result = run_load_test(args.recipients, work_dir, transport, pdf_options)
+            logger.info(f"SMTP server received {server.message_count} messages, {server.byte_count} bytes")
+
+    logger.info(
+        f"rendered {result['recipients']} recipients in {result['render_seconds']:.2f}s "
+        f"({result['render_per_second']:.0f}/s), "
+        f"sent {result['sent']} messages in {result['send_seconds']:.2f}s ({result['send_per_second']:.0f}/s)"
+    )
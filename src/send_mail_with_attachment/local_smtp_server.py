@@ -0,0 +1,86 @@
+"""
+Minimal in-process SMTP server, receiving messages for tests and load tests
+"""
+import socketserver
+import threading
+from typing import List
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    """Handles one SMTP session: EHLO/HELO, MAIL, RCPT, DATA, RSET, NOOP and QUIT"""
+
+    server: "LocalSMTPServer"
+
+    def reply(self, line: str):
+        self.wfile.write(f"{line}\r\n".encode())
+
+    def handle(self):
+        self.reply("220 localhost ESMTP test server")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode("utf-8", errors="replace").strip().split(" ", 1)[0].upper()
+            if command == "EHLO":
+                self.reply("250-localhost")
+                self.reply("250 8BITMIME")
+            elif command in ("HELO", "MAIL", "RCPT", "RSET", "NOOP"):
+                self.reply("250 OK")
+            elif command == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                self.server.receive(self.read_data())
+                self.reply("250 OK")
+            elif command == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("502 Command not implemented")
+
+    def read_data(self) -> bytes:
+        lines = []
+        while True:
+            line = self.rfile.readline()
+            if not line or line == b".\r\n":
+                return b"".join(lines)
+            # Undo the dot-stuffing
+            lines.append(line[1:] if line.startswith(b".") else line)
+
+
+class LocalSMTPServer(socketserver.ThreadingTCPServer):
+    """
+    SMTP server listening on localhost, in a background thread.
+
+    It counts the messages and bytes received, and keeps the messages when `keep_messages` is set.
+    Use as a context manager: the server runs within the `with` block.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port: int = 0, keep_messages: bool = False):
+        super().__init__(("127.0.0.1", port), _SMTPHandler)
+        self.keep_messages = keep_messages
+        self.messages: List[bytes] = []
+        self.message_count = 0
+        self.byte_count = 0
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    def receive(self, data: bytes):
+        with self._lock:
+            self.message_count += 1
+            self.byte_count += len(data)
+            if self.keep_messages:
+                self.messages.append(data)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
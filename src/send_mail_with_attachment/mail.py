@@ -2,22 +2,23 @@
 Mail functions
 """
 
+import base64
 import smtplib
+from email import policy
+from email.message import EmailMessage
 from email.mime.application import MIMEApplication
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.utils import formatdate
 from os.path import basename
-from typing import List
+from typing import BinaryIO, Iterable, List
+from uuid import uuid4
 
+# Read attachments by chunks of whole base64 lines (57 bytes encode to a 76 characters line)
+CHUNK_SIZE = 57 * 1024
 
-def get_smtp_server(host: str, port: int, user: str, password: str) -> smtplib.SMTP:
-    "Prepares smtp server instance from environment variables"
-
-    server = smtplib.SMTP_SSL(host, port)
-    server.ehlo()
-    server.login(user, password)
-    return server
+# Send spooled messages to the SMTP server by batches of this size
+SEND_BUFFER_SIZE = 64 * 1024
 
 
 def prepare_message(
@@ -53,3 +54,113 @@ def prepare_message(
         msg.attach(part)
 
     return msg
+
+
+def write_message(
+    spool_file: BinaryIO,
+    send_from: str,
+    send_to: str,
+    reply_to: str | None,
+    subject: str,
+    html_chunks: Iterable[str],
+    file_paths: List[str],
+):
+    """
+    Write an email with HTML and attachments to a binary spool file, ready to be sent with `send_spooled_message`.
+
+    The HTML and the attachments are base64 encoded chunk by chunk, so the memory used does not depend
+    on the size of the message.
+    """
+
+    boundary = f'==============={uuid4().hex}=='
+
+    # Headers are built with the SMTP policy, which RFC 2047 encodes non-ASCII values (e.g. the subject)
+    headers = EmailMessage(policy=policy.SMTP)
+    headers['From'] = send_from
+    headers['To'] = send_to
+    headers['Date'] = formatdate(localtime=True)
+    headers['Subject'] = subject
+    if reply_to:
+        headers['Reply-To'] = reply_to
+    headers['MIME-Version'] = '1.0'
+    headers['Content-Type'] = f'multipart/mixed; boundary="{boundary}"'
+    headers.set_payload('')
+    spool_file.write(headers.as_bytes())
+
+    spool_file.write(f'--{boundary}\r\n'.encode())
+    spool_file.write(
+        b'Content-Type: text/html; charset="utf-8"\r\n'
+        b'MIME-Version: 1.0\r\n'
+        b'Content-Transfer-Encoding: base64\r\n'
+        b'\r\n'
+    )
+    _write_base64(spool_file, (chunk.encode('utf-8') for chunk in html_chunks))
+
+    for file_path in file_paths or []:
+        attachment_name = basename(file_path)
+        spool_file.write(f'--{boundary}\r\n'.encode())
+        # Non-ASCII file names are RFC 2231 encoded
+        attachment_headers = EmailMessage(policy=policy.SMTP)
+        attachment_headers['Content-Type'] = 'application/octet-stream'
+        attachment_headers.set_param('name', attachment_name)
+        attachment_headers['MIME-Version'] = '1.0'
+        attachment_headers['Content-Transfer-Encoding'] = 'base64'
+        attachment_headers.add_header('Content-Disposition', 'attachment', filename=attachment_name)
+        attachment_headers.set_payload('')
+        spool_file.write(attachment_headers.as_bytes())
+        with open(file_path, "rb") as file_handle:
+            _write_base64(spool_file, iter(lambda: file_handle.read(CHUNK_SIZE), b''))
+
+    spool_file.write(f'--{boundary}--\r\n'.encode())
+
+
+def _write_base64(spool_file: BinaryIO, chunks: Iterable[bytes]):
+    """base64 encode byte chunks into CRLF terminated lines"""
+
+    pending = b''
+    for chunk in chunks:
+        pending += chunk
+        complete_lines_length = len(pending) - len(pending) % 57
+        if complete_lines_length:
+            spool_file.write(base64.encodebytes(pending[:complete_lines_length]).replace(b'\n', b'\r\n'))
+            pending = pending[complete_lines_length:]
+    if pending:
+        spool_file.write(base64.encodebytes(pending).replace(b'\n', b'\r\n'))
+
+
+def send_spooled_message(server: smtplib.SMTP, send_from: str, send_to: str, spool_file: BinaryIO):
+    """Send a message written by `write_message`, streaming it from the spool file to the SMTP server"""
+
+    server.ehlo_or_helo_if_needed()
+
+    code, response = server.mail(send_from)
+    if code != 250:
+        server.rset()
+        raise smtplib.SMTPSenderRefused(code, response, send_from)
+
+    code, response = server.rcpt(send_to)
+    if code not in (250, 251):
+        server.rset()
+        raise smtplib.SMTPRecipientsRefused({send_to: (code, response)})
+
+    code, response = server.docmd('data')
+    if code != 354:
+        server.rset()
+        raise smtplib.SMTPDataError(code, response)
+
+    buffer = bytearray()
+    for line in spool_file:
+        # Dot-stuffing, see RFC 5321 section 4.5.2
+        if line.startswith(b'.'):
+            buffer += b'.'
+        buffer += line
+        if len(buffer) >= SEND_BUFFER_SIZE:
+            server.send(bytes(buffer))
+            buffer.clear()
+    buffer += b'.\r\n'
+    server.send(bytes(buffer))
+
+    code, response = server.getreply()
+    if code != 250:
+        server.rset()
+        raise smtplib.SMTPDataError(code, response)
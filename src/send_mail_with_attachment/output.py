@@ -0,0 +1,102 @@
+"""
+Output files of a send-out: unique, deterministic paths and atomic writes
+"""
+from collections import Counter
+from contextlib import contextmanager
+import hashlib
+import json
+import os
+from typing import Iterable, Iterator
+from uuid import uuid4
+
+
+class OutputManager:
+    """
+    Paths of the files generated for each record id, in `output_dir`.
+
+    - Record ids are checked up front: duplicate ids would overwrite each other's files.
+    - With `fanout` > 0, files are spread in subdirectories named after the first `fanout` hex characters
+      of a hash of the id (e.g. 2 for 256 subdirectories), which keeps directories small enough to list
+      and archive quickly. Paths only depend on the id, so they are the same across parallel or resumed runs.
+    - Files are written through a temporary file in the same directory, renamed once complete: a crashed
+      run never leaves partial files behind.
+    - A digest of the inputs of a file can be written next to it, so that a resumed run only reuses the files
+      generated from the same inputs.
+    """
+
+    def __init__(self, output_dir: str, file_prefix: str, fanout: int = 0):
+        self.output_dir = output_dir
+        self.file_prefix = file_prefix
+        self.fanout = fanout
+
+    def check_ids(self, ids: Iterable[str]):
+        """Raise when ids are duplicated or cannot be used in file names"""
+
+        id_counts = Counter(ids)
+        duplicate_ids = sorted(id for id, count in id_counts.items() if count > 1)
+        if duplicate_ids:
+            raise ValueError(f"There are {len(duplicate_ids)} duplicate ids: {duplicate_ids}")
+
+        invalid_ids = sorted(id for id in id_counts if os.sep in id or id in (".", ".."))
+        if invalid_ids:
+            raise ValueError(f"There are {len(invalid_ids)} ids which cannot be used in file names: {invalid_ids}")
+
+    def path(self, id: str, extension: str) -> str:
+        """Path of the file for a record id"""
+
+        directory = self.output_dir
+        if self.fanout:
+            directory = os.path.join(directory, hashlib.sha1(id.encode("utf-8")).hexdigest()[:self.fanout])
+        return os.path.join(directory, f"{self.file_prefix}{id}.{extension}")
+
+    @contextmanager
+    def atomic_path(self, path: str) -> Iterator[str]:
+        """
+        Temporary path to write `path` to, moved to `path` when the block completes.
+        The temporary file is removed if the block fails.
+        """
+
+        directory, name = os.path.split(path)
+        os.makedirs(directory, exist_ok=True)
+        stem, extension = os.path.splitext(name)
+        # Keep the extension, wkhtmltopdf uses it to pick the output format
+        tmp_path = os.path.join(directory, f".{stem}.{uuid4().hex}.tmp{extension}")
+        try:
+            yield tmp_path
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def digest_path(self, path: str) -> str:
+        """Path of the digest of the inputs of `path`"""
+
+        return f"{path}.sha256"
+
+    def write_digest(self, path: str, digest: str):
+        """Write the digest of the inputs `path` was just generated from, see `input_digest`"""
+
+        with self.atomic_path(self.digest_path(path)) as tmp_digest_path:
+            with open(tmp_digest_path, "w") as digest_file:
+                digest_file.write(digest)
+
+    def is_current(self, path: str, digest: str) -> bool:
+        """Whether `path` exists and was generated from inputs with `digest`"""
+
+        if not os.path.exists(path):
+            return False
+        try:
+            with open(self.digest_path(path)) as digest_file:
+                return digest_file.read() == digest
+        except FileNotFoundError:
+            return False
+
+
+def input_digest(input_path: str, options: dict) -> str:
+    """sha256 digest of an input file and of the options it is converted with"""
+
+    digest = hashlib.sha256(json.dumps(options, sort_keys=True).encode("utf-8"))
+    with open(input_path, "rb") as input_file:
+        for chunk in iter(lambda: input_file.read(64 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
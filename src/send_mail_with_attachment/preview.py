@@ -0,0 +1,69 @@
+"""
+Send-out preview: extrapolate the cost of a send-out from a sample of rendered attachments
+"""
+import math
+from typing import List
+
+
+def sample_positions(record_count: int, sample_size: int) -> List[int]:
+    """Positions of `sample_size` records spread evenly over `record_count` records"""
+
+    if sample_size <= 0 or record_count == 0:
+        return []
+    if sample_size >= record_count:
+        return list(range(record_count))
+    step = record_count / sample_size
+    return [int(i * step) for i in range(sample_size)]
+
+
+def base64_size(byte_count: int) -> int:
+    """Size of a MIME base64 encoded payload, including the CRLF line endings"""
+
+    return math.ceil(byte_count / 3) * 4 + math.ceil(byte_count / 57) * 2
+
+
+def estimate_sendout(
+    record_count: int,
+    template_render_seconds: float,
+    email_html_bytes: List[int],
+    sample_pdf_seconds: List[float],
+    sample_pdf_bytes: List[int],
+) -> dict:
+    """
+    Estimate the render time, output bytes and SMTP volume of a send-out.
+
+    The templates are rendered for all records, so their cost and the email sizes are measured.
+    The pdf render time and size are extrapolated from the sample.
+    """
+
+    sample_count = len(sample_pdf_bytes)
+    average_pdf_seconds = sum(sample_pdf_seconds) / sample_count if sample_count else 0.0
+    average_pdf_bytes = sum(sample_pdf_bytes) / sample_count if sample_count else 0.0
+
+    pdf_bytes = round(average_pdf_bytes * record_count)
+    html_bytes = sum(email_html_bytes)
+
+    # Each recipient gets their email and their pdf, the report gets the archive of all of them
+    smtp_bytes = sum(base64_size(size) for size in email_html_bytes) \
+        + record_count * base64_size(round(average_pdf_bytes)) \
+        + base64_size(pdf_bytes + html_bytes)
+
+    return {
+        "records": record_count,
+        "sampled_records": sample_count,
+        "render_seconds": template_render_seconds + average_pdf_seconds * record_count,
+        "output_bytes": pdf_bytes,
+        "smtp_bytes": smtp_bytes,
+    }
+
+
+def format_estimate(estimate: dict) -> str:
+    """Human readable send-out estimate"""
+
+    return (
+        f"Estimated send-out for {estimate['records']} records "
+        f"(pdfs sampled from {estimate['sampled_records']} records):\n"
+        f"  render time: {estimate['render_seconds']:.1f}s\n"
+        f"  output: {estimate['output_bytes'] / 1e6:.1f}MB of pdfs\n"
+        f"  SMTP volume: {estimate['smtp_bytes'] / 1e6:.1f}MB"
+    )
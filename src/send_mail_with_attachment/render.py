@@ -0,0 +1,109 @@
+"""
+Template rendering with a context layer shared by all records
+"""
+import os
+from typing import Iterable, Type
+from jinja2 import Environment, FileSystemLoader, Undefined, select_autoescape
+
+from shared.row_utils import expand_record_lists, get_column_schema
+
+
+class RecordRenderer:
+    """
+    Renders the email and attachment templates of each record.
+
+    The template context is split in two layers:
+    - a global layer computed once per send-out (e.g. today's date, or values scattered from the meta rows),
+      set as template globals,
+    - a per-record layer, passed at render time.
+
+    `<item>.<index>.<field>` lists found in both layers are merged for each record, the record values taking
+    precedence, with the indices and their fields in the order of the input columns.
+    """
+
+    def __init__(
+        self,
+        email_template_path: str,
+        attachment_template_path: str,
+        columns: Iterable[str],
+        global_context: dict,
+        undefined: Type[Undefined] = Undefined,
+    ):
+        self._email_template_path = email_template_path
+        self._attachment_template_path = attachment_template_path
+        self._email_environment = _template_environment(email_template_path, undefined)
+        self._attachment_environment = _template_environment(attachment_template_path, undefined)
+        # Shared with the loaded templates, so that the global layer can change without compiling them again
+        self._template_globals: dict = {}
+        self.set_context(columns, global_context)
+
+    def set_context(self, columns: Iterable[str], global_context: dict):
+        """
+        Set the input columns and the global layer, e.g. when the input CSV of a watched send-out changes.
+
+        The templates are only compiled again if their files changed since they were loaded.
+        """
+
+        # The field names of the records are only parsed once, for all records
+        columns = list(columns)
+        self._schema = get_column_schema(columns)
+        expanded_global_context = expand_record_lists(global_context)
+        self._global_lists = {
+            field: value for field, value in expanded_global_context.items() if isinstance(value, dict)
+        }
+        self._template_globals.clear()
+        self._template_globals.update(
+            (field, value) for field, value in expanded_global_context.items() if field not in self._global_lists
+        )
+
+        # Order of the list indices and of their fields, as they appear in the input columns
+        self._list_fields = {
+            field: {index: list(subfields) for index, subfields in indices.items()}
+            for field, indices in expand_record_lists(dict.fromkeys(columns), schema=self._schema).items()
+            if isinstance(indices, dict)
+        }
+
+        self.email_template = self._email_environment.get_template(
+            os.path.basename(self._email_template_path), globals=self._template_globals
+        )
+        self.attachment_template = self._attachment_environment.get_template(
+            os.path.basename(self._attachment_template_path), globals=self._template_globals
+        )
+
+    def record_context(self, record) -> dict:
+        """Per-record template context, merged with the global lists"""
+
+        context = expand_record_lists(record, schema=self._schema)
+        for field, global_list in self._global_lists.items():
+            record_list = context.get(field, {})
+            list_fields = self._list_fields.get(field, {})
+            context[field] = {
+                index: _merge_item(
+                    record_list.get(index, {}), global_list.get(index, {}), list_fields.get(index, ())
+                )
+                for index in list_fields or global_list
+            }
+        return context
+
+    def render_email(self, context: dict) -> str:
+        return self.email_template.render(context)
+
+    def render_attachment(self, context: dict, path: str):
+        """Render the attachment template to a file, writing it as it is generated"""
+
+        self.attachment_template.stream(context).dump(path, encoding="utf-8")
+
+
+def _merge_item(record_item: dict, global_item: dict, subfields: Iterable[str]) -> dict:
+    # Record values take precedence, fields in the order of the input columns then any other field
+    item = {**global_item, **record_item}
+    return {subfield: item[subfield] for subfield in (*subfields, *item) if subfield in item}
+
+
+def _template_environment(path: str, undefined: Type[Undefined]) -> Environment:
+    # Templates are cached by the environment, and compiled again when their file changes
+    return Environment(
+        loader=FileSystemLoader(os.path.dirname(path)),
+        autoescape=select_autoescape(),
+        undefined=undefined,
+    )
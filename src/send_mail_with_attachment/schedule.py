@@ -0,0 +1,101 @@
+"""
+Send-out scheduling: interleave recipient domains, rate limit and retry transient SMTP errors
+"""
+from collections import deque
+import heapq
+import itertools
+import logging
+import smtplib
+import time
+from typing import Callable, Deque, Dict, Iterable, List, Optional, Tuple, TypeVar
+
+logger = logging.getLogger(__name__)
+
+Message = TypeVar("Message")
+
+
+def recipient_domain(email: str) -> str:
+    return email.strip().rpartition("@")[2].casefold()
+
+
+def is_transient_error(error: Exception) -> bool:
+    """4xx SMTP replies are temporary failures (e.g. greylisting or throttling), which can be retried"""
+
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return bool(error.recipients) and all(400 <= code < 500 for code, _ in error.recipients.values())
+    if isinstance(error, smtplib.SMTPResponseException):
+        return 400 <= error.smtp_code < 500
+    return False
+
+
+class SendScheduler:
+    """
+    Sends messages grouped by recipient domain.
+
+    The domains are interleaved, so that consecutive messages go to different providers, and rate limited:
+    - `messages_per_second` limits the overall send rate,
+    - `domain_messages_per_minute` limits the send rate to each recipient domain.
+
+    A message failing with a transient (4xx) SMTP error is retried up to `max_retries` times. Its domain is
+    backed off exponentially from `retry_delay` seconds, while the other domains keep being served.
+    Other errors, and transient errors once the retries are exhausted, are raised.
+    """
+
+    def __init__(
+        self,
+        messages_per_second: Optional[float] = None,
+        domain_messages_per_minute: Optional[float] = None,
+        max_retries: int = 3,
+        retry_delay: float = 60.0,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], None] = time.sleep,
+    ):
+        self.interval = 1 / messages_per_second if messages_per_second else 0.0
+        self.domain_interval = 60 / domain_messages_per_minute if domain_messages_per_minute else 0.0
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.clock = clock
+        self.sleep = sleep
+
+    def run(self, messages: Iterable[Tuple[str, Message]], send: Callable[[Message], None]) -> int:
+        """Send (recipient email, message) pairs, returns the number of messages sent"""
+
+        queues: Dict[str, Deque[Tuple[int, Message]]] = {}
+        for recipient_email, message in messages:
+            queues.setdefault(recipient_domain(recipient_email), deque()).append((0, message))
+
+        # Domains by time they can be sent to next, then by order of arrival for a round robin
+        sequence = itertools.count()
+        ready_domains: List[Tuple[float, int, str]] = [(0.0, next(sequence), domain) for domain in queues]
+        heapq.heapify(ready_domains)
+        next_send_time = 0.0
+        sent_count = 0
+
+        while ready_domains:
+            domain_ready_time, _, domain = heapq.heappop(ready_domains)
+            wait = max(domain_ready_time, next_send_time) - self.clock()
+            if wait > 0:
+                self.sleep(wait)
+
+            now = self.clock()
+            next_send_time = now + self.interval
+            queue = queues[domain]
+            retries, message = queue.popleft()
+
+            try:
+                send(message)
+            except Exception as error:
+                if not is_transient_error(error) or retries >= self.max_retries:
+                    raise
+                delay = self.retry_delay * 2 ** retries
+                logger.warning(f"transient error sending to {domain}, retrying in {delay:.0f}s: {error}")
+                queue.appendleft((retries + 1, message))
+                domain_ready_time = now + delay
+            else:
+                sent_count += 1
+                domain_ready_time = now + self.domain_interval
+
+            if queue:
+                heapq.heappush(ready_domains, (domain_ready_time, next(sequence), domain))
+
+        return sent_count
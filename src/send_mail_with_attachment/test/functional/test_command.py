@@ -0,0 +1,212 @@
+import email
+import email.policy
+import os
+import pathlib
+import shutil
+import subprocess
+import sys
+
+from send_mail_with_attachment.local_smtp_server import LocalSMTPServer
+
+SRC_DIR = pathlib.Path(__file__).parents[3]
+
+# Runs the entry point with --help and reports the heavy modules imported and the time spent
+STARTUP_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+from send_mail_with_attachment.command import main
+sys.argv = ["send-mail-with-attachment", "--help"]
+try:
+    main()
+except SystemExit:
+    pass
+heavy_modules = sorted({"pandas", "jinja2", "pdfkit", "smtplib"}.intersection(sys.modules))
+print(f"{heavy_modules} {time.perf_counter() - start:.3f}", file=sys.stderr)
+"""
+
+
+# Runs the entry point with the arguments following the script
+COMMAND_SCRIPT = """
+import sys
+from send_mail_with_attachment.command import main
+sys.argv[0] = "send-mail-with-attachment"
+main()
+"""
+
+TEMPLATE_DIR = SRC_DIR.parent / "test-data" / "test-send-mail-with-attachment-template"
+
+# Stands in for pdfkit where wkhtmltopdf is not installed: the "pdf" is a copy of the html
+PDFKIT_STUB = """
+import shutil
+
+def from_file(input_path, output_path, options=None):
+    shutil.copyfile(input_path, output_path)
+"""
+
+
+def run_without_smtp_settings(args, **env_overrides):
+    env = {key: value for key, value in os.environ.items() if not key.startswith("SMTP_")}
+    env.update(env_overrides)
+    return subprocess.run(
+        [sys.executable, *args],
+        check=False,
+        capture_output=True,
+        cwd=SRC_DIR,
+        env=env,
+    )
+
+
+def test_command_line_outputs_help_without_smtp_settings():
+    response = run_without_smtp_settings(["-c", STARTUP_SCRIPT])
+    assert response.returncode == 0
+    assert "usage:" in response.stdout.decode()
+
+
+def test_command_line_help_starts_without_heavy_imports():
+    response = run_without_smtp_settings(["-c", STARTUP_SCRIPT])
+    heavy_modules, startup_seconds = response.stderr.decode().strip().rsplit(" ", 1)
+    assert heavy_modules == "[]"
+    # Generous bound: importing pandas alone takes several times longer
+    assert float(startup_seconds) < 0.25
+
+
+def sendout_args(tmp_path, template_dir=TEMPLATE_DIR):
+    return [
+        "--id-field", "invoice_id",
+        "--email-field", "gocardless_email",
+        "--input-request-csv", str(template_dir / "invoice-requests.csv"),
+        "--input-email-template-html", str(template_dir / "email.html"),
+        "--input-attachment-template-html", str(template_dir / "invoice.html"),
+        "--attachment-file-prefix", "invoice",
+        "--email-subject", "Facture école",
+        "--output-dir", str(tmp_path / "output"),
+    ]
+
+
+def test_command_line_requires_email_sender_without_smtp_username(tmp_path):
+    response = run_without_smtp_settings([
+        "-c", COMMAND_SCRIPT,
+        *sendout_args(tmp_path),
+        "--transport", "maildir",
+        "--maildir", str(tmp_path / "maildir"),
+    ])
+
+    assert response.returncode != 0
+    assert "--email-sender is required" in response.stderr.decode()
+    # Nothing was rendered
+    assert not (tmp_path / "output").exists()
+
+
+def test_command_line_does_not_watch_actual_send_outs(tmp_path):
+    response = run_without_smtp_settings(["-c", COMMAND_SCRIPT, *sendout_args(tmp_path), "--watch", "--force"])
+
+    assert response.returncode != 0
+    assert "--watch and --force cannot be used together" in response.stderr.decode()
+    assert not (tmp_path / "output").exists()
+
+
+def pdfkit_env(tmp_path):
+    """Environment using the pdfkit stub, if wkhtmltopdf is not installed"""
+    if shutil.which("wkhtmltopdf") is not None:
+        return {}
+    stub_dir = tmp_path / "stubs"
+    stub_dir.mkdir(exist_ok=True)
+    (stub_dir / "pdfkit.py").write_text(PDFKIT_STUB)
+    return {"PYTHONPATH": str(stub_dir)}
+
+
+def test_command_line_sends_all_emails_and_report_to_local_smtp_server(tmp_path):
+    env_overrides = pdfkit_env(tmp_path)
+
+    with LocalSMTPServer(keep_messages=True) as server:
+        response = run_without_smtp_settings(
+            [
+                "-c", COMMAND_SCRIPT,
+                *sendout_args(tmp_path),
+                "--transport", "smtp",
+                "--email-sender", "sender@test.email",
+                "--force",
+            ],
+            SMTP_HOST="127.0.0.1",
+            SMTP_PORT=str(server.port),
+            **env_overrides,
+        )
+
+    assert response.returncode == 0, response.stderr.decode()
+    messages = [email.message_from_bytes(message, policy=email.policy.default) for message in server.messages]
+    *recipient_messages, report = messages
+
+    assert sorted(message["To"] for message in recipient_messages) == [
+        "albert.dupont@test.email",
+        "georges.smith@test.email",
+        "speling_mistake@test.email",
+    ]
+    assert all(message["From"] == "sender@test.email" for message in recipient_messages)
+    assert [attachment.get_filename() for attachment in recipient_messages[0].iter_attachments()] == [
+        "invoiceabc-autumn-01.pdf",
+    ]
+
+    assert report["To"] == "sender@test.email"
+    assert report["Subject"] == "Email sendout report: Facture école"
+    assert "records: 3 rendered, 3 sent" in report.get_body().get_content()
+    assert [attachment.get_filename() for attachment in report.iter_attachments()] == [
+        "invoicesendout.zip",
+        "invoicesendout.log.gz",
+    ]
+
+
+def test_command_line_preview_leaves_output_dir_untouched(tmp_path):
+    # Strict preview: the templates must only use columns of the csv
+    template_dir = tmp_path / "templates"
+    template_dir.mkdir()
+    shutil.copy(TEMPLATE_DIR / "invoice-requests.csv", template_dir)
+    (template_dir / "email.html").write_text("<p>Dear {{ parent_name }},</p>")
+    (template_dir / "invoice.html").write_text("<p>Invoice {{ invoice_id }}: {{ amount_due }}</p>")
+
+    maildir_args = ["--transport", "maildir", "--maildir", str(tmp_path / "maildir"), "--email-sender", "s@test.email"]
+    response = run_without_smtp_settings(
+        ["-c", COMMAND_SCRIPT, *sendout_args(tmp_path, template_dir), *maildir_args],
+        **pdfkit_env(tmp_path),
+    )
+    assert response.returncode == 0, response.stderr.decode()
+    output_files = {path.name: path.read_bytes() for path in (tmp_path / "output").iterdir()}
+    assert "invoicesendout.zip" in output_files
+
+    response = run_without_smtp_settings(
+        ["-c", COMMAND_SCRIPT, *sendout_args(tmp_path, template_dir), "--preview", "--preview-sample-size", "2"],
+        **pdfkit_env(tmp_path),
+    )
+    assert response.returncode == 0, response.stderr.decode()
+    assert {path.name: path.read_bytes() for path in (tmp_path / "output").iterdir()} == output_files
+
+
+def test_command_line_resume_renders_changed_attachments_again(tmp_path):
+    template_dir = tmp_path / "templates"
+    template_dir.mkdir()
+    shutil.copy(TEMPLATE_DIR / "invoice-requests.csv", template_dir)
+    (template_dir / "email.html").write_text("<p>Dear {{ parent_name }},</p>")
+    attachment_template_path = template_dir / "invoice.html"
+
+    def dry_run(*args):
+        response = run_without_smtp_settings(
+            [
+                "-c", COMMAND_SCRIPT,
+                *sendout_args(tmp_path, template_dir),
+                "--transport", "maildir",
+                "--maildir", str(tmp_path / "maildir"),
+                "--email-sender", "s@test.email",
+                *args,
+            ],
+            **pdfkit_env(tmp_path),
+        )
+        assert response.returncode == 0, response.stderr.decode()
+        return response.stderr.decode().count("reusing ")
+
+    attachment_template_path.write_text("<p>Invoice {{ invoice_id }}: {{ amount_due }}</p>")
+    assert dry_run() == 0
+    assert dry_run("--resume") == 3
+    # Other pdf options, or another attachment: rendered again
+    assert dry_run("--resume", "--attachment-profile", "compact") == 0
+    attachment_template_path.write_text("<p>Invoice {{ invoice_id }}, total: {{ amount_due }}</p>")
+    assert dry_run("--resume", "--attachment-profile", "compact") == 0
+    assert dry_run("--resume", "--attachment-profile", "compact") == 3
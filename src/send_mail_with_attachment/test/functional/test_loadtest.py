@@ -0,0 +1,30 @@
+import email
+
+from send_mail_with_attachment.loadtest import run_load_test
+from send_mail_with_attachment.local_smtp_server import LocalSMTPServer
+from send_mail_with_attachment.transport import MaildirTransport, SMTPTransport
+
+
+def test_load_test_sends_all_messages_to_local_smtp_server(tmp_path):
+    with LocalSMTPServer(keep_messages=True) as server:
+        transport = SMTPTransport("127.0.0.1", server.port, security="smtp")
+        result = run_load_test(100, str(tmp_path), transport)
+
+    assert result["sent"] == 100
+    assert server.message_count == 100
+
+    recipients = [email.message_from_bytes(message)["To"] for message in server.messages]
+    # Recipient domains are interleaved
+    assert recipients[:4] == ["parent0@gmail.com", "parent1@outlook.com", "parent2@yahoo.co.uk", "parent3@test.email"]
+    assert len(set(recipients)) == 100
+
+    attachment = email.message_from_bytes(server.messages[0]).get_payload()[1]
+    assert attachment.get_filename() == "invoice-ID0.html"
+    assert "Language lessons" in attachment.get_payload(decode=True).decode()
+
+
+def test_load_test_delivers_to_maildir(tmp_path):
+    result = run_load_test(10, str(tmp_path), MaildirTransport(str(tmp_path / "maildir")))
+
+    assert result["sent"] == 10
+    assert len(list((tmp_path / "maildir" / "new").iterdir())) == 10
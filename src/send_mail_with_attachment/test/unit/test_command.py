@@ -0,0 +1,35 @@
+import pytest
+
+from send_mail_with_attachment.command import PDF_PROFILES, get_pdf_options
+
+
+def test_get_pdf_options_merges_profile_into_base_options():
+    assert get_pdf_options("print") == {
+        "enable-local-file-access": None,
+        "disable-smart-shrinking": '',
+        "page-size": "A4",
+        "dpi": 400,
+    }
+
+    compact_options = get_pdf_options("compact")
+    assert {key: compact_options[key] for key in PDF_PROFILES["compact"]} == PDF_PROFILES["compact"]
+    assert compact_options["page-size"] == "A4"
+
+
+def test_get_pdf_options_overrides_profile():
+    options = get_pdf_options("standard", dpi=200, image_dpi=100, image_quality=50)
+
+    assert options["dpi"] == 200
+    assert options["image-dpi"] == 100
+    assert options["image-quality"] == 50
+    # The profiles are not modified by the overrides
+    assert PDF_PROFILES["standard"] == {"dpi": 300, "image-dpi": 300, "image-quality": 90}
+
+    assert get_pdf_options("print", image_quality=0)["image-quality"] == 0
+    assert get_pdf_options("print", image_quality=100)["image-quality"] == 100
+
+
+@pytest.mark.parametrize("image_quality", [-1, 101])
+def test_get_pdf_options_rejects_image_quality_out_of_range(image_quality):
+    with pytest.raises(ValueError, match="must be between 0 and 100"):
+        get_pdf_options("compact", image_quality=image_quality)
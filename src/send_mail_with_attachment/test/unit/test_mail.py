@@ -0,0 +1,105 @@
+import email
+import email.policy
+import io
+import smtplib
+
+import pytest
+
+from send_mail_with_attachment.mail import send_spooled_message, write_message
+
+
+class RecordingSMTP(smtplib.SMTP):
+    """SMTP client recording the commands and data instead of using a socket"""
+
+    def __init__(self, reply_codes=(250, 250, 354, 250)):
+        super().__init__()
+        self.commands = []
+        self.data = b''
+        self.reply_codes = list(reply_codes)
+
+    def ehlo_or_helo_if_needed(self):
+        pass
+
+    def putcmd(self, cmd, args=""):
+        self.commands.append(f"{cmd} {args}".strip())
+
+    def getreply(self):
+        return self.reply_codes.pop(0), b"reply"
+
+    def send(self, s):
+        self.data += s
+
+
+def test_write_message_streams_html_and_attachments(tmp_path):
+    attachment_path = tmp_path / "invoice-ID1.pdf"
+    attachment_bytes = bytes(range(256)) * 1000
+    attachment_path.write_bytes(attachment_bytes)
+
+    spool_file = io.BytesIO()
+    write_message(
+        spool_file,
+        "sender@test.email",
+        "parent@test.email",
+        "reply@test.email",
+        "Your invoice",
+        ["<p>Dear parent,</p>", "<p>Café</p>"],
+        [str(attachment_path)],
+    )
+
+    message = email.message_from_bytes(spool_file.getvalue())
+    html_part, attachment_part = message.get_payload()
+
+    assert message["To"] == "parent@test.email"
+    assert message["Reply-To"] == "reply@test.email"
+    assert message["Subject"] == "Your invoice"
+    assert html_part.get_content_type() == "text/html"
+    assert html_part.get_payload(decode=True).decode("utf-8") == "<p>Dear parent,</p><p>Café</p>"
+    assert attachment_part.get_filename() == "invoice-ID1.pdf"
+    assert attachment_part.get_payload(decode=True) == attachment_bytes
+    assert all(line.endswith(b"\r\n") for line in spool_file.getvalue().splitlines(keepends=True))
+
+
+def test_send_spooled_message_sends_dot_stuffed_data():
+    server = RecordingSMTP()
+
+    send_spooled_message(
+        server,
+        "sender@test.email",
+        "parent@test.email",
+        io.BytesIO(b"Subject: test\r\n\r\n.hidden line\r\nvisible line\r\n"),
+    )
+
+    assert server.commands == ["mail FROM:<sender@test.email>", "rcpt TO:<parent@test.email>", "data"]
+    assert server.data == b"Subject: test\r\n\r\n..hidden line\r\nvisible line\r\n.\r\n"
+
+
+def test_send_spooled_message_raises_when_recipient_is_refused():
+    server = RecordingSMTP(reply_codes=(250, 550, 250))
+
+    with pytest.raises(smtplib.SMTPRecipientsRefused):
+        send_spooled_message(server, "sender@test.email", "parent@test.email", io.BytesIO(b"\r\n"))
+
+    assert server.commands == ["mail FROM:<sender@test.email>", "rcpt TO:<parent@test.email>", "rset"]
+
+
+def test_write_message_encodes_non_ascii_headers(tmp_path):
+    attachment_path = tmp_path / "facture-école.pdf"
+    attachment_path.write_bytes(b"%PDF")
+
+    spool_file = io.BytesIO()
+    write_message(
+        spool_file,
+        "sender@test.email",
+        "parent@test.email",
+        None,
+        "Facture école",
+        ["<p>Café</p>"],
+        [str(attachment_path)],
+    )
+
+    assert spool_file.getvalue().isascii()
+    message = email.message_from_bytes(spool_file.getvalue(), policy=email.policy.default)
+    _, attachment_part = message.iter_parts()
+    assert message["Subject"] == "Facture école"
+    assert attachment_part.get_filename() == "facture-école.pdf"
+    assert attachment_part.get_content() == b"%PDF"
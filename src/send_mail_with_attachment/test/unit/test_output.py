@@ -0,0 +1,64 @@
+import os
+
+import pytest
+
+from send_mail_with_attachment.output import OutputManager, input_digest
+
+
+def test_check_ids_rejects_duplicates_and_unsafe_names():
+    output = OutputManager("/tmp/out", "invoice_")
+    output.check_ids(["1", "2", "3"])
+
+    with pytest.raises(ValueError, match=r"2 duplicate ids: \['1', '2'\]"):
+        output.check_ids(["1", "2", "1", "2", "3"])
+
+    with pytest.raises(ValueError, match="cannot be used in file names"):
+        output.check_ids(["1", "../2"])
+
+
+def test_path_fans_out_on_id_hash():
+    assert OutputManager("/tmp/out", "invoice_").path("42", "pdf") == "/tmp/out/invoice_42.pdf"
+
+    fanned_out_path = OutputManager("/tmp/out", "invoice_", fanout=2).path("42", "pdf")
+    assert fanned_out_path == "/tmp/out/92/invoice_42.pdf"
+    assert OutputManager("/tmp/out", "invoice_", fanout=2).path("42", "pdf") == fanned_out_path
+
+
+def test_atomic_path_replaces_file_on_success_only(tmp_path):
+    output = OutputManager(str(tmp_path), "invoice_", fanout=1)
+    path = output.path("42", "pdf")
+
+    with output.atomic_path(path) as tmp_file_path:
+        assert tmp_file_path.endswith(".pdf")
+        with open(tmp_file_path, "w") as tmp_file:
+            tmp_file.write("complete")
+
+    with pytest.raises(RuntimeError):
+        with output.atomic_path(path) as tmp_file_path:
+            with open(tmp_file_path, "w") as tmp_file:
+                tmp_file.write("partial")
+            raise RuntimeError("wkhtmltopdf crashed")
+
+    with open(path) as output_file:
+        assert output_file.read() == "complete"
+    assert os.listdir(os.path.dirname(path)) == ["invoice_42.pdf"]
+
+
+def test_is_current_compares_input_digests(tmp_path):
+    output = OutputManager(str(tmp_path), "invoice_")
+    path = output.path("42", "pdf")
+    html_path = tmp_path / "invoice_42.html"
+    html_path.write_text("<p>42</p>")
+    digest = input_digest(str(html_path), {"dpi": 400})
+
+    assert not output.is_current(path, digest)
+    with open(path, "w") as pdf_file:
+        pdf_file.write("pdf")
+    # Written by a run which did not record its inputs
+    assert not output.is_current(path, digest)
+
+    output.write_digest(path, digest)
+    assert output.is_current(path, digest)
+    assert not output.is_current(path, input_digest(str(html_path), {"dpi": 300}))
+    html_path.write_text("<p>43</p>")
+    assert not output.is_current(path, input_digest(str(html_path), {"dpi": 400}))
@@ -0,0 +1,35 @@
+import base64
+
+import pytest
+
+from send_mail_with_attachment.preview import base64_size, estimate_sendout, sample_positions
+
+
+def test_sample_positions_are_spread_over_records():
+    assert sample_positions(record_count=10, sample_size=3) == [0, 3, 6]
+    assert sample_positions(record_count=2, sample_size=3) == [0, 1]
+    assert sample_positions(record_count=10, sample_size=0) == []
+
+
+def test_base64_size_matches_mime_encoding():
+    for byte_count in [0, 1, 56, 57, 58, 1000]:
+        encoded = base64.encodebytes(b"x" * byte_count).replace(b"\n", b"\r\n")
+        assert base64_size(byte_count) == len(encoded)
+
+
+def test_estimate_sendout_extrapolates_from_sample():
+    estimate = estimate_sendout(
+        record_count=100,
+        template_render_seconds=0.5,
+        email_html_bytes=[570] * 100,
+        sample_pdf_seconds=[0.2, 0.4],
+        sample_pdf_bytes=[5700, 11400],
+    )
+
+    assert estimate["records"] == 100
+    assert estimate["sampled_records"] == 2
+    assert estimate["render_seconds"] == pytest.approx(0.5 + 0.3 * 100)
+    assert estimate["output_bytes"] == 8550 * 100
+    assert estimate["smtp_bytes"] == (
+        100 * base64_size(570) + 100 * base64_size(8550) + base64_size(8550 * 100 + 570 * 100)
+    )
@@ -0,0 +1,47 @@
+from send_mail_with_attachment.render import RecordRenderer
+
+
+def test_record_renderer_overlays_record_on_global_context(tmp_path):
+    (tmp_path / "email.html").write_text("Dear {{ name }}, {{ today }}")
+    (tmp_path / "invoice.html").write_text(
+        "{% for index, item_line in item_lines.items() %}{{ index }}:{{ item_line.title }}={{ item_line.amount }};"
+        "{% endfor %}"
+    )
+
+    renderer = RecordRenderer(
+        str(tmp_path / "email.html"),
+        str(tmp_path / "invoice.html"),
+        columns=["name", "item_lines.2.amount", "item_lines.1.amount", "item_lines.1.title", "item_lines.2.title"],
+        global_context={
+            "today": "01/02/2023",
+            "item_lines.1.title": "Lessons",
+            "item_lines.2.title": "Membership",
+        },
+    )
+
+    context = renderer.record_context({"name": "Pierre", "item_lines.2.amount": 10.0, "item_lines.1.amount": 90.0})
+    renderer.render_attachment(context, str(tmp_path / "invoice-1.html"))
+
+    assert renderer.render_email(context) == "Dear Pierre, 01/02/2023"
+    assert (tmp_path / "invoice-1.html").read_text() == "2:Membership=10.0;1:Lessons=90.0;"
+
+
+def test_record_renderer_keeps_list_fields_in_column_order(tmp_path):
+    (tmp_path / "email.html").write_text("")
+    (tmp_path / "invoice.html").write_text(
+        "{% for index, item_line in item_lines.items() %}"
+        "{% for field, value in item_line.items() %}{{ field }}={{ value }};{% endfor %}"
+        "{% endfor %}"
+    )
+
+    renderer = RecordRenderer(
+        str(tmp_path / "email.html"),
+        str(tmp_path / "invoice.html"),
+        columns=["item_lines.1.amount", "item_lines.1.title", "item_lines.1.vat"],
+        global_context={"item_lines.1.title": "T", "item_lines.1.vat": "0"},
+    )
+
+    context = renderer.record_context({"item_lines.1.amount": 5, "item_lines.1.vat": "1"})
+    renderer.render_attachment(context, str(tmp_path / "invoice-1.html"))
+
+    assert (tmp_path / "invoice-1.html").read_text() == "amount=5;title=T;vat=1;"
@@ -0,0 +1,84 @@
+import smtplib
+
+import pytest
+
+from send_mail_with_attachment.schedule import SendScheduler, is_transient_error
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def test_send_scheduler_interleaves_domains():
+    sent = []
+    scheduler = SendScheduler()
+
+    scheduler.run(
+        [
+            ("a1@gmail.com", "a1"),
+            ("a2@gmail.com", "a2"),
+            ("a3@Gmail.com", "a3"),
+            ("b1@test.email", "b1"),
+            ("c1@other.email", "c1"),
+            ("b2@test.email", "b2"),
+        ],
+        sent.append,
+    )
+
+    assert sent == ["a1", "b1", "c1", "a2", "b2", "a3"]
+
+
+def test_send_scheduler_rate_limits_domains_and_overall():
+    clock = FakeClock()
+    send_times = {}
+    scheduler = SendScheduler(
+        messages_per_second=2,
+        domain_messages_per_minute=30,
+        clock=clock,
+        sleep=clock.sleep,
+    )
+
+    scheduler.run(
+        [("a1@gmail.com", "a1"), ("a2@gmail.com", "a2"), ("b1@test.email", "b1")],
+        lambda message: send_times.setdefault(message, clock.now),
+    )
+
+    assert send_times == {"a1": 0.0, "b1": 0.5, "a2": 2.0}
+
+
+def test_send_scheduler_retries_transient_errors_with_backoff():
+    clock = FakeClock()
+    attempts = []
+
+    def send(message):
+        attempts.append((message, clock.now))
+        if message == "a1" and [attempt[0] for attempt in attempts].count("a1") < 3:
+            raise smtplib.SMTPDataError(451, b"try again later")
+
+    scheduler = SendScheduler(max_retries=3, retry_delay=10, clock=clock, sleep=clock.sleep)
+    sent_count = scheduler.run([("a1@gmail.com", "a1"), ("b1@test.email", "b1")], send)
+
+    assert sent_count == 2
+    assert attempts == [("a1", 0.0), ("b1", 0.0), ("a1", 10.0), ("a1", 30.0)]
+
+
+def test_send_scheduler_raises_permanent_errors():
+    def send(message):
+        raise smtplib.SMTPRecipientsRefused({"a1@gmail.com": (550, b"no such user")})
+
+    with pytest.raises(smtplib.SMTPRecipientsRefused):
+        SendScheduler().run([("a1@gmail.com", "a1")], send)
+
+
+def test_is_transient_error():
+    assert is_transient_error(smtplib.SMTPSenderRefused(421, b"too many connections", "me@test.email"))
+    assert is_transient_error(smtplib.SMTPRecipientsRefused({"a@gmail.com": (450, b"greylisted")}))
+    assert not is_transient_error(smtplib.SMTPDataError(554, b"rejected"))
+    assert not is_transient_error(ValueError())
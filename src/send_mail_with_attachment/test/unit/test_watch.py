@@ -0,0 +1,57 @@
+import os
+import pathlib
+import shutil
+import sys
+
+import pytest
+
+from send_mail_with_attachment.command import parse_args
+from send_mail_with_attachment.watch import SendoutSession
+
+TEMPLATE_DIR = pathlib.Path(__file__).parents[4] / "test-data" / "test-send-mail-with-attachment-template"
+
+
+def test_sendout_session_keeps_records_and_renderer_across_template_changes(tmp_path, monkeypatch):
+    shutil.copy(TEMPLATE_DIR / "invoice-requests.csv", tmp_path)
+    email_path = tmp_path / "email.html"
+    email_path.write_text("<p>Dear {{ parent_name }}, {{ currency }}</p>")
+    (tmp_path / "invoice.html").write_text("<p>Invoice {{ invoice_id }}: {{ amount_due }}</p>")
+
+    monkeypatch.setattr(sys, "argv", [
+        "send-mail-with-attachment",
+        "--id-field", "invoice_id",
+        "--email-field", "gocardless_email",
+        "--input-request-csv", str(tmp_path / "invoice-requests.csv"),
+        "--input-email-template-html", str(email_path),
+        "--input-attachment-template-html", str(tmp_path / "invoice.html"),
+        "--attachment-file-prefix", "invoice",
+        "--email-subject", "Invoice",
+        "--output-dir", str(tmp_path / "output"),
+        "--preview",
+        "--preview-sample-size", "0",
+        "--watch",
+    ])
+    session = SendoutSession(parse_args(), email_sender=None)
+
+    with pytest.raises(ValueError, match="There are 3 records with undefined template variables"):
+        session.run(session.input_paths)
+    invoice_df = session.invoice_df
+    renderer = session.renderer
+    email_template = renderer.email_template
+
+    email_path.write_text("<p>Dear {{ parent_name }}</p>")
+    # Templates are compiled again when their modification time changes
+    os.utime(email_path, ns=(email_path.stat().st_atime_ns, email_path.stat().st_mtime_ns + 10**9))
+    session.run([str(email_path)])
+
+    assert session.invoice_df is invoice_df
+    assert session.renderer is renderer
+    assert renderer.email_template is not email_template
+    assert renderer.render_email({"parent_name": "Albert"}) == "<p>Dear Albert</p>"
+
+    # Unchanged templates are not compiled again
+    email_template = renderer.email_template
+    session.run([str(tmp_path / "invoice-requests.csv")])
+    assert session.invoice_df is not invoice_df
+    assert renderer.email_template is email_template
+    assert not (tmp_path / "output").exists()
@@ -0,0 +1,101 @@
+"""
+Mail transports: SMTP servers, or a local maildir sink
+"""
+from email.message import Message
+import mailbox
+import smtplib
+import ssl
+from typing import BinaryIO, Optional
+
+from send_mail_with_attachment.mail import send_spooled_message
+
+SMTP_TRANSPORTS = ["smtp-ssl", "smtp-starttls", "smtp"]
+
+
+class SMTPTransport:
+    """
+    Sends messages through an SMTP server, over SSL ("smtp-ssl"), upgraded with STARTTLS ("smtp-starttls")
+    or in plain text ("smtp", e.g. for a local test server).
+
+    The connection is opened on first use, and opened again if the server has closed it,
+    e.g. after a 421 reply or an idle timeout while the attachments are rendered.
+    """
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        user: Optional[str] = None,
+        password: Optional[str] = None,
+        security: str = "smtp-ssl",
+    ):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.security = security
+        self._server: Optional[smtplib.SMTP] = None
+
+    def _connection(self) -> smtplib.SMTP:
+        if self._server is None or self._server.sock is None:
+            if self.security == "smtp-ssl":
+                server: smtplib.SMTP = smtplib.SMTP_SSL(self.host, self.port)
+            else:
+                server = smtplib.SMTP(self.host, self.port)
+            server.ehlo()
+            if self.security == "smtp-starttls":
+                server.starttls(context=ssl.create_default_context())
+                server.ehlo()
+            if self.user:
+                server.login(self.user, self.password or "")
+            self._server = server
+        return self._server
+
+    def send_message(self, message: Message):
+        self._connection().send_message(message)
+
+    def send_spooled_message(self, send_from: str, send_to: str, spool_file: BinaryIO):
+        send_spooled_message(self._connection(), send_from, send_to, spool_file)
+
+    def close(self):
+        if self._server is not None and self._server.sock is not None:
+            self._server.quit()
+        self._server = None
+
+
+class MaildirTransport:
+    """Delivers messages to a local maildir, e.g. to inspect a send-out without a mail server"""
+
+    def __init__(self, path: str):
+        self.maildir = mailbox.Maildir(path, create=True)
+
+    def send_message(self, message: Message):
+        self.maildir.add(message)
+
+    def send_spooled_message(self, send_from: str, send_to: str, spool_file: BinaryIO):
+        # Maildir copies binary files line by line
+        self.maildir.add(spool_file)
+
+    def close(self):
+        pass
+
+
+def get_transport(
+    transport: str,
+    host: Optional[str] = None,
+    port: Optional[int] = None,
+    user: Optional[str] = None,
+    password: Optional[str] = None,
+    maildir: Optional[str] = None,
+):
+    """Transport from the --transport argument"""
+
+    if transport == "maildir":
+        if not maildir:
+            raise ValueError("--maildir is required with --transport maildir")
+        return MaildirTransport(maildir)
+    if transport not in SMTP_TRANSPORTS:
+        raise ValueError(f"{transport=} must be maildir or one of {SMTP_TRANSPORTS}")
+    if not host or not port:
+        raise ValueError(f"SMTP host and port are required with --transport {transport}")
+    return SMTPTransport(host, port, user, password, security=transport)
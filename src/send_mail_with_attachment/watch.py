@@ -0,0 +1,66 @@
+"""
+Keep the records and the compiled templates of a send-out in memory, to preview it while its inputs are edited
+"""
+import argparse
+import logging
+from typing import Iterable, Optional
+
+import pandas
+
+from send_mail_with_attachment.command import create_renderer, get_global_context, load_records, sendout
+from send_mail_with_attachment.render import RecordRenderer
+from shared.log_utils import RunLog
+
+logger = logging.getLogger(__name__)
+
+
+class SendoutSession:
+    """
+    Previews or dry runs a send-out (see `send_mail_with_attachment.command.sendout`), caching between runs:
+
+    - records: the input request CSV, read and processed with its meta rows, re-read when it changes,
+    - renderer: the compiled templates, only compiled again when a template file changes.
+
+    Each run captures its own log, as the report of a dry run attaches it.
+    """
+
+    def __init__(self, args: argparse.Namespace, email_sender: Optional[str]):
+        self.args = args
+        self.email_sender = email_sender
+        self.invoice_df: Optional[pandas.DataFrame] = None
+        self.columns: list = []
+        self.constant_record: dict = {}
+        self.renderer: Optional[RecordRenderer] = None
+
+    @property
+    def input_paths(self):
+        return [
+            str(self.args.input_request_csv),
+            str(self.args.input_email_template_html),
+            str(self.args.input_attachment_template_html),
+        ]
+
+    def run(self, changed_paths: Iterable[str]):
+        """Re-read the records if they changed (or were not read yet), and preview or dry run the send-out"""
+
+        if self.invoice_df is None or str(self.args.input_request_csv) in set(changed_paths):
+            # Cleared first, so that failed records are read again on the next change of any file
+            self.invoice_df = None
+            invoice_df, self.columns, self.constant_record = load_records(self.args)
+            self.invoice_df = invoice_df
+            logger.info(f"loaded {len(self.invoice_df)} records")
+
+        if self.renderer is None:
+            self.renderer = create_renderer(self.args, self.columns, self.constant_record)
+        else:
+            # Also picks up the changed templates, and the date of the day
+            self.renderer.set_context(self.columns, get_global_context(self.args, self.constant_record))
+
+        run_log = RunLog(spill=not self.args.preview)
+        root_logger = logging.getLogger()
+        root_logger.addHandler(run_log)
+        try:
+            sendout(self.args, run_log, self.email_sender, self.invoice_df, self.renderer)
+        finally:
+            root_logger.removeHandler(run_log)
+            run_log.close()
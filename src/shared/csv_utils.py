@@ -1,6 +1,7 @@
-import math
 import pandas
 
+from shared.row_utils import _is_empty, _map_value_or_default, get_column_schema
+
 
 def process_csv_with_metadata(input_df: pandas.DataFrame) -> pandas.DataFrame:
     """"
@@ -19,6 +20,8 @@ def process_csv_with_metadata(input_df: pandas.DataFrame) -> pandas.DataFrame:
     meta amount_due item_lines.1.amount payments.0.amount item_lines.1.header payments.0.header payments.0.charge_date
              123.45              123.45            123.45              Item 1           Payment             2023-02-01
     ```
+
+    The appended columns are categoricals, see `_scatter_value`.
     """
     # Drop unnamed columns
     output_df = input_df.loc[:, ~input_df.columns.str.contains('^Unnamed')].copy(deep=True)
@@ -27,25 +30,22 @@ def process_csv_with_metadata(input_df: pandas.DataFrame) -> pandas.DataFrame:
     if "meta" not in columns:
         return output_df
 
+    # Only the <item>.<index>.<field> columns receive meta values
+    schema = get_column_schema(columns)
+    list_columns = [(column, schema.parts(column)) for column in columns if schema.parts(column)]
     meta_column_names = []
     for index, row in output_df.iterrows():
         if isinstance(row["meta"], str) and row["meta"]:
             meta_value = row["meta"]
             if meta_value != "-":
                 # Merge all values from row into <item>.<index>.<field> fields
-                for column in columns:
+                for column, (item, item_index, _) in list_columns:
                     if not _is_empty(row[column]):
-                        column_parts = column.split(".")
-                        if len(column_parts) != 3:
-                            # Skip columns which are not in the form <item>.<index>.<field>
-                            continue
-                        column_parts[-1] = meta_value
-                        meta_column_name = ".".join(column_parts)
+                        meta_column_name = schema.separator.join([item, item_index, meta_value])
                         meta_column_names.append(meta_column_name)
                         if meta_column_name not in columns:
                             # Do not overwrite existing columns in the dataframe
-                            output_df[meta_column_name] = output_df[column].apply(
-                                lambda v: _map_value_or_default(v, row[column]))
+                            output_df[meta_column_name] = _scatter_value(output_df[column], row[column])
             output_df.drop(index=index, inplace=True)
         else:
             break
@@ -53,46 +53,42 @@ def process_csv_with_metadata(input_df: pandas.DataFrame) -> pandas.DataFrame:
     return output_df
 
 
-def _is_empty(v):
-    if isinstance(v, str):
-        if v == "":
-            return True
-    elif isinstance(v, float):
-        if (v == 0.0 or math.isnan(v)):
-            return True
-    return False
-
-
-def _map_value_or_default(origin_column_value, scattered_value):
-    empty = _is_empty(origin_column_value)
-    if empty and isinstance(scattered_value, str):
-        return ""
-    elif empty and isinstance(scattered_value, float):
-        return 0.0
-    return scattered_value
-
+def _scatter_value(origin_column: pandas.Series, scattered_value) -> pandas.Series:
+    """
+    Scatter a meta value over the rows, or its empty default where the origin column is empty.
 
-# Record = dict[str, float | str | "Record"]
-def expand_record_lists(record: dict[str, str], separator='.'):
-    # -> Record
+    The column is stored as a categorical: the value and its default are stored once, with a small integer code
+    per row, rather than one object reference per row.
     """
-    Transform a flat csv row into a row containing lists of dictionaries
-    For example, `field.123.subfield` will be transformed into a structure
-    of shape     `field[123][subfield]`
+    default_value = _map_value_or_default("", scattered_value)
+    categories = list(dict.fromkeys([scattered_value, default_value]))
+    codes = origin_column.map(_is_empty).map({
+        True: categories.index(default_value),
+        False: categories.index(scattered_value),
+    })
+    return pandas.Series(
+        pandas.Categorical.from_codes(codes, categories=categories),
+        index=origin_column.index,
+    )
+
+
+def split_constant_columns(input_df: pandas.DataFrame, keep_columns=()) -> tuple[pandas.DataFrame, dict]:
     """
-    output_record: dict = {}
-    for field, value in record.items():
-        parts = field.rsplit(separator, maxsplit=3)
-        if len(parts) == 3:
-            [output_field, index, output_subfield] = parts
-            if output_field not in output_record:
-                output_record[output_field] = {}
-            if index not in output_record[output_field]:  # type: ignore
-                output_record[output_field][index] = {}  # type: ignore
-            output_record[output_field][index][output_subfield] = value  # type: ignore
-        else:
-            output_record[field] = value
-    return output_record
+    Split out the columns holding the same value on every row, e.g. the values scattered from the meta rows.
+
+    Returns the dataframe without these columns, and a record of their values which can be shared by all rows.
+    `keep_columns` are never split out.
+    """
+    if len(input_df) == 0:
+        return input_df, {}
+
+    constant_columns = [
+        column
+        for column in input_df.columns
+        if column not in keep_columns and input_df[column].nunique(dropna=False) <= 1
+    ]
+    constant_record = {column: input_df[column].iloc[0] for column in constant_columns}
+    return input_df.drop(columns=constant_columns), constant_record
 
 
 def doc_print_df(df: pandas.DataFrame, name: str = 'dataframe:'):
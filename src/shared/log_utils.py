@@ -0,0 +1,144 @@
+from collections import Counter, deque
+import logging
+import shutil
+from typing import BinaryIO, Deque, List, Optional
+
+
+def configure_logging(spill: bool = False, max_chars: int = 256 * 1024) -> "RunLog":
+    """
+    Log everything from DEBUG level to stderr, and capture the log in a bounded `RunLog` for the send-out reports.
+
+    Called from the command entry points rather than at import time, so that importing a command module
+    does not alter the logging configuration.
+    """
+    logging.basicConfig(level=logging.DEBUG)
+    run_log = RunLog(max_chars=max_chars, spill=spill)
+    logging.getLogger().addHandler(run_log)
+    return run_log
+
+
+def log_record_status(logger: logging.Logger, record_id: str, status: str, message: str = ""):
+    """Log a status line for a record (e.g. "sent"), counted by status in the run log summary"""
+
+    logger.info(
+        f"record {record_id}: {status}" + (f": {message}" if message else ""),
+        extra={"record_id": record_id, "record_status": status},
+    )
+
+
+class RunLog(logging.Handler):
+    """
+    Captures the log of a run in bounded memory, for the send-out reports:
+
+    - the last lines, up to `max_chars` in total, in a ring buffer, each line truncated to `max_line_length`
+      (e.g. for DataFrame dumps),
+    - the last warnings and errors, so that they are reported even once they are out of the ring buffer,
+    - line counts by level and record counts by status (see `log_record_status`),
+    - with `spill`, the full log, gzip compressed into a temporary file as it is written.
+
+    `summary` gives a compact report of the run, and `write_compressed` writes the full log.
+    """
+
+    def __init__(
+        self,
+        max_chars: int = 256 * 1024,
+        max_line_length: int = 2000,
+        max_problem_lines: int = 20,
+        spill: bool = False,
+    ):
+        super().__init__()
+        self.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+        self.max_chars = max_chars
+        self.max_line_length = max_line_length
+        self.line_count = 0
+        self.level_counts: Counter = Counter()
+        self.status_counts: Counter = Counter()
+        self._lines: Deque[str] = deque()
+        self._chars = 0
+        self._problem_lines: Deque[str] = deque(maxlen=max_problem_lines)
+
+        self._spill_file: Optional[BinaryIO] = None
+        self._spill: Optional[BinaryIO] = None
+        if spill:
+            # Imported here, as most runs do not spill their log
+            import gzip
+            import tempfile
+
+            self._spill_file = tempfile.TemporaryFile(prefix="py-charity-utils_log_")
+            self._spill = gzip.GzipFile(fileobj=self._spill_file, mode="wb")
+
+    def emit(self, record: logging.LogRecord):
+        try:
+            line = self.format(record)
+        except Exception:
+            self.handleError(record)
+            return
+
+        self.line_count += 1
+        self.level_counts[record.levelname] += 1
+        status = getattr(record, "record_status", None)
+        if status:
+            self.status_counts[status] += 1
+
+        if self._spill:
+            self._spill.write(line.encode("utf-8", "backslashreplace") + b"\n")
+
+        if len(line) > self.max_line_length:
+            line = f"{line[:self.max_line_length]}... ({len(line) - self.max_line_length} more characters)"
+        if record.levelno >= logging.WARNING:
+            self._problem_lines.append(line)
+
+        self._lines.append(line)
+        self._chars += len(line) + 1
+        while self._chars > self.max_chars and len(self._lines) > 1:
+            self._chars -= len(self._lines.popleft()) + 1
+
+    @property
+    def lines(self) -> List[str]:
+        """Last lines of the log, as kept in the ring buffer"""
+        return list(self._lines)
+
+    def summary(self) -> str:
+        """Line counts, record statuses, last warnings and errors, and the last lines of the log"""
+
+        summary_lines = [
+            f"{self.line_count} log lines: " +
+            ", ".join(f"{count} {level}" for level, count in sorted(self.level_counts.items())),
+        ]
+        if self.status_counts:
+            summary_lines.append(
+                "records: " + ", ".join(f"{count} {status}" for status, count in self.status_counts.items())
+            )
+        if self._problem_lines:
+            summary_lines += [f"last {len(self._problem_lines)} warnings and errors:", *self._problem_lines]
+        summary_lines += [f"last {len(self._lines)} lines:", *self._lines]
+        return "\n".join(summary_lines)
+
+    def write_compressed(self, path: str):
+        """
+        Write the full log, gzip compressed, to `path`. Requires `spill`.
+
+        The log is written as captured so far: lines logged afterwards are only kept in the ring buffer.
+        """
+
+        with self.lock:
+            spill, self._spill = self._spill, None
+            spill_file, self._spill_file = self._spill_file, None
+        if spill is None or spill_file is None:
+            raise ValueError("The full log is only kept with spill=True, and can only be written once")
+
+        spill.close()
+        spill_file.seek(0)
+        with open(path, "wb") as output_file:
+            shutil.copyfileobj(spill_file, output_file)
+        spill_file.close()
+
+    def close(self):
+        with self.lock:
+            if self._spill:
+                self._spill.close()
+                self._spill = None
+            if self._spill_file:
+                self._spill_file.close()
+                self._spill_file = None
+        super().close()
@@ -0,0 +1,162 @@
+"""
+Pure-Python helpers for csv rows as dictionaries, which do not import pandas
+"""
+import functools
+import math
+from typing import Dict, Iterable, List, Mapping, Optional, Tuple
+
+
+class ColumnSchema:
+    """
+    Column names of a sheet, with the `<item>.<index>.<field>` names parsed once.
+
+    For columns `payments.1.amount, payments.1.charge_date, payments.2.amount`:
+    - `parts("payments.2.amount")` is `("payments", "2", "amount")`, or None for other columns,
+    - `indexed_columns("payments", "amount")` is `{"1": "payments.1.amount", "2": "payments.2.amount"}`,
+    - `column("payments", "1", "charge_date")` is `"payments.1.charge_date"`.
+
+    Use `get_column_schema` to share the schema of a set of columns between processing stages.
+    """
+
+    def __init__(self, columns: Iterable[str], separator: str = '.'):
+        self.columns = tuple(columns)
+        self.separator = separator
+        self._parts: Dict[str, Optional[Tuple[str, str, str]]] = {}
+        self._indexed_columns: Dict[Tuple[str, str], Dict[str, str]] = {}
+        for column in self.columns:
+            parts = self.parts(column)
+            if parts:
+                (item, index, field) = parts
+                self._indexed_columns.setdefault((item, field), {})[index] = column
+
+    def parts(self, column: str) -> Optional[Tuple[str, str, str]]:
+        """(item, index, field) of a `<item>.<index>.<field>` column, None for other columns"""
+        try:
+            return self._parts[column]
+        except KeyError:
+            parts = str(column).split(self.separator)
+            self._parts[column] = (parts[0], parts[1], parts[2]) if len(parts) == 3 else None
+            return self._parts[column]
+
+    def indexed_columns(self, item: str, field: str, numbered: bool = False) -> Dict[str, str]:
+        """
+        Columns of a field for each index of an item, in column order.
+        With `numbered`, only the indices made of digits.
+        """
+        indexed_columns = self._indexed_columns.get((item, field), {})
+        if numbered:
+            return {index: column for index, column in indexed_columns.items() if index.isdigit()}
+        return dict(indexed_columns)
+
+    def column(self, item: str, index: str, field: str) -> str:
+        """Name of the column of a field for an index of an item, raises KeyError if there is no such column"""
+        indexed_columns = self._indexed_columns.get((item, field), {})
+        if index not in indexed_columns:
+            raise KeyError(self.separator.join([item, index, field]))
+        return indexed_columns[index]
+
+
+@functools.lru_cache(maxsize=32)
+def _cached_column_schema(columns: Tuple[str, ...], separator: str) -> ColumnSchema:
+    return ColumnSchema(columns, separator)
+
+
+def get_column_schema(columns: Iterable[str], separator: str = '.') -> ColumnSchema:
+    """Schema of a set of columns, parsed once and shared by all callers passing the same columns"""
+    return _cached_column_schema(tuple(columns), separator)
+
+
+def process_rows_with_metadata(input_rows: Iterable[Mapping]) -> List[dict]:
+    """
+    Pure-Python equivalent of `process_csv_with_metadata`, for rows as dictionaries (e.g. from `csv.DictReader`).
+
+    Missing values are NaN, as in a dataframe built from the same rows. Cheaper than building a dataframe for
+    a handful of rows.
+    """
+    rows = [dict(row) for row in input_rows]
+
+    # Columns in order of first appearance, without unnamed columns
+    columns = [
+        column for column in dict.fromkeys(column for row in rows for column in row)
+        if not str(column).startswith("Unnamed")
+    ]
+    rows = [{column: row.get(column, math.nan) for column in columns} for row in rows]
+
+    if "meta" not in columns:
+        return rows
+
+    schema = get_column_schema(columns)
+    list_columns = [(column, schema.parts(column)) for column in columns if schema.parts(column)]
+    output_columns = list(columns)
+    scattered_values: dict = {}
+    meta_row_count = 0
+    for row in rows:
+        if not (isinstance(row["meta"], str) and row["meta"]):
+            break
+        meta_row_count += 1
+        meta_value = row["meta"]
+        if meta_value == "-":
+            continue
+        # Merge all values from row into <item>.<index>.<field> fields
+        for column, (item, item_index, _) in list_columns:
+            if not _is_empty(row[column]):
+                meta_column_name = schema.separator.join([item, item_index, meta_value])
+                if meta_column_name not in columns:
+                    # Do not overwrite existing columns
+                    if meta_column_name not in scattered_values:
+                        output_columns.append(meta_column_name)
+                    scattered_values[meta_column_name] = (column, row[column])
+
+    output_rows = []
+    for row in rows[meta_row_count:]:
+        for meta_column_name in output_columns[len(columns):]:
+            column, scattered_value = scattered_values[meta_column_name]
+            row[meta_column_name] = _map_value_or_default(row[column], scattered_value)
+        output_rows.append(row)
+    return output_rows
+
+
+def _is_empty(v):
+    if isinstance(v, str):
+        if v == "":
+            return True
+    elif isinstance(v, float):
+        if (v == 0.0 or math.isnan(v)):
+            return True
+    return False
+
+
+def _map_value_or_default(origin_column_value, scattered_value):
+    empty = _is_empty(origin_column_value)
+    if empty and isinstance(scattered_value, str):
+        return ""
+    elif empty and isinstance(scattered_value, float):
+        return 0.0
+    return scattered_value
+
+
+# Record = dict[str, float | str | "Record"]
+def expand_record_lists(record: dict[str, str], separator='.', schema: Optional[ColumnSchema] = None):
+    # -> Record
+    """
+    Transform a flat csv row into a row containing lists of dictionaries
+    For example, `field.123.subfield` will be transformed into a structure
+    of shape     `field[123][subfield]`
+
+    Pass the `schema` of the columns when expanding many records, so that the field names are only parsed once.
+    """
+    if schema is None:
+        schema = ColumnSchema((), separator)
+    output_record: dict = {}
+    for field, value in record.items():
+        parts = schema.parts(field)
+        if parts:
+            [output_field, index, output_subfield] = parts
+            if output_field not in output_record:
+                output_record[output_field] = {}
+            if index not in output_record[output_field]:  # type: ignore
+                output_record[output_field][index] = {}  # type: ignore
+            output_record[output_field][index][output_subfield] = value  # type: ignore
+        else:
+            output_record[field] = value
+    return output_record
@@ -1,6 +1,7 @@
 import pandas
 
-from shared.csv_utils import process_csv_with_metadata
+from shared.csv_utils import process_csv_with_metadata, split_constant_columns
+from shared.row_utils import process_rows_with_metadata
 
 
 def assert_frames_equal(left: pandas.DataFrame, right: pandas.DataFrame, **kwds):
@@ -134,3 +135,88 @@ def test_read_csv_with_metadata_fills_empty_values_for_empty_reference():
 
     assert set(processed_df.columns) == set(expected_df.columns)
     assert_frames_equal(processed_df, expected_df)
+
+
+def test_split_constant_columns():
+    df = pandas.DataFrame([
+        {
+            "id": "ID1",
+            "amount_due": "123.45",
+            "item_lines.1.amount": "123.45",
+            "item_lines.1.header": "Item 1",
+        },
+        {
+            "id": "ID2",
+            "amount_due": "23.45",
+            "item_lines.1.amount": "23.45",
+            "item_lines.1.header": "Item 1",
+        },
+    ])
+
+    varying_df, constant_record = split_constant_columns(df, keep_columns=["id"])
+
+    assert list(varying_df.columns) == ["id", "amount_due", "item_lines.1.amount"]
+    assert constant_record == {"item_lines.1.header": "Item 1"}
+
+
+def test_read_csv_with_metadata_stores_scattered_values_as_categoricals():
+    df = pandas.DataFrame([
+        # header rows
+        {
+            "meta": "header",
+            "item_lines.1.amount": "Item 1",
+        },
+        # invoice request rows
+        *[
+            {
+                "meta": "",
+                "item_lines.1.amount": "10" if i % 2 else "",
+            }
+            for i in range(100)
+        ]
+    ])
+
+    processed_df = process_csv_with_metadata(df)
+
+    assert processed_df["item_lines.1.header"].dtype == "category"
+    assert list(processed_df["item_lines.1.header"].cat.categories) == ["Item 1", ""]
+    assert processed_df["item_lines.1.header"].tolist() == ["Item 1" if i % 2 else "" for i in range(100)]
+
+
+def test_process_rows_with_metadata_matches_dataframe_version():
+    rows = [
+        # header rows
+        {
+            "meta": "header",
+            "amount_due": "Total",
+            "item_lines.1.amount": "Item 1",
+            "payments.0.amount": "Payment",
+        },
+        {
+            "meta": "-",
+            "amount_due": "skipped",
+        },
+        {
+            "meta": "charge_date",
+            "amount_due": "",
+            "item_lines.1.amount": "",
+            "payments.0.amount": "2023-02-01",
+        },
+        # invoice request rows
+        {
+            "meta": "",
+            "amount_due": "123.45",
+            "item_lines.1.amount": "123.45",
+            "payments.0.amount": "123.45",
+        },
+        {
+            "meta": "",
+            "amount_due": "",
+            "item_lines.1.amount": "",
+        },
+    ]
+
+    processed_rows = process_rows_with_metadata(rows)
+
+    assert pandas.DataFrame(processed_rows).to_json(orient="records") == \
+        process_csv_with_metadata(pandas.DataFrame(rows)).to_json(orient="records")
@@ -0,0 +1,58 @@
+import gzip
+import logging
+
+import pytest
+
+from shared.log_utils import RunLog, log_record_status
+
+
+@pytest.fixture
+def logger():
+    logger = logging.getLogger("test_run_log")
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    yield logger
+    logger.handlers.clear()
+
+
+def test_run_log_keeps_last_lines_within_bounds(logger):
+    run_log = RunLog(max_chars=200, max_line_length=50)
+    logger.addHandler(run_log)
+
+    logger.warning("invoice dataframe:\n" + "x" * 1000)
+    for i in range(100):
+        logger.debug(f"line {i}")
+
+    assert run_log.line_count == 101
+    assert sum(len(line) + 1 for line in run_log.lines) <= 200
+    assert run_log.lines[-1] == "DEBUG:test_run_log:line 99"
+
+    summary = run_log.summary()
+    assert summary.startswith("101 log lines: 100 DEBUG, 1 WARNING")
+    # The warning is out of the ring buffer, but still reported, truncated
+    assert "WARNING:test_run_log:invoice dataframe:\nxxx" in summary
+    assert "(990 more characters)" in summary
+
+
+def test_run_log_counts_record_statuses_and_spills_full_log(logger, tmp_path):
+    run_log = RunLog(max_chars=100, spill=True)
+    logger.addHandler(run_log)
+
+    for i in range(50):
+        log_record_status(logger, str(i), "sent" if i % 10 else "skipped", f"parent{i}@test.email")
+
+    assert "records: 5 skipped, 45 sent" in run_log.summary()
+
+    log_path = tmp_path / "sendout.log.gz"
+    run_log.write_compressed(log_path)
+    logger.info("after the log was written")
+
+    with gzip.open(log_path, "rt") as log_file:
+        full_log = log_file.read().splitlines()
+    assert len(full_log) == 50
+    assert full_log[1] == "INFO:test_run_log:record 1: sent: parent1@test.email"
+    assert run_log.lines[-1] == "INFO:test_run_log:after the log was written"
+
+    with pytest.raises(ValueError):
+        run_log.write_compressed(log_path)
+    run_log.close()
@@ -0,0 +1,22 @@
+import pytest
+
+from shared.row_utils import get_column_schema
+
+
+def test_column_schema_indexes_list_columns():
+    schema = get_column_schema([
+        "parent_id", "payments.1.amount", "payments.1.charge_date", "payments.x.amount", "payments.2.amount",
+        "item_lines.1.amount", "a.b.c.d",
+    ])
+
+    assert schema.parts("payments.2.amount") == ("payments", "2", "amount")
+    assert schema.parts("parent_id") is None
+    assert schema.parts("a.b.c.d") is None
+    assert schema.indexed_columns("payments", "amount") == {
+        "1": "payments.1.amount", "x": "payments.x.amount", "2": "payments.2.amount",
+    }
+    assert list(schema.indexed_columns("payments", "amount", numbered=True)) == ["1", "2"]
+    assert schema.column("payments", "1", "charge_date") == "payments.1.charge_date"
+    with pytest.raises(KeyError):
+        schema.column("payments", "2", "charge_date")
+    assert get_column_schema(schema.columns) is schema
@@ -0,0 +1,38 @@
+import os
+
+from shared.watch import FileWatcher, watch
+
+
+def test_file_watcher_reports_changed_files(tmp_path):
+    first_path = tmp_path / "first.csv"
+    second_path = tmp_path / "second.csv"
+    first_path.write_text("a\n")
+    watcher = FileWatcher([first_path, second_path])
+
+    assert watcher.changed() == [str(first_path)]
+    assert watcher.changed() == []
+
+    second_path.write_text("b\n")
+    assert watcher.changed() == [str(second_path)]
+
+    first_path.write_text("a\n1\n")
+    os.remove(second_path)
+    assert watcher.changed() == [str(first_path), str(second_path)]
+
+
+def test_watch_keeps_running_after_failed_runs(tmp_path):
+    path = tmp_path / "input.csv"
+    path.write_text("\n")
+    runs = []
+
+    def on_change(changed_paths):
+        runs.append(changed_paths)
+        if len(runs) == 1:
+            raise ValueError("invalid csv")
+
+    def edit(interval):
+        path.write_text(f"{len(runs)}\n" * (len(runs) + 1))
+
+    watch(FileWatcher([path]), on_change, sleep=edit, max_polls=3)
+
+    assert runs == [[str(path)], [str(path)], [str(path)]]
@@ -0,0 +1,73 @@
+"""
+Poll input files for changes, to re-run a command while its inputs are being edited
+"""
+import logging
+import os
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Type
+
+logger = logging.getLogger(__name__)
+
+FileSignature = Optional[Tuple[int, int]]
+
+# Errors raised on invalid input files, which are expected to be fixed by a later edit
+INPUT_ERRORS: Tuple[Type[Exception], ...] = (AssertionError, ValueError, KeyError, OSError)
+
+
+class FileWatcher:
+    """
+    Reports which of `paths` changed since the last call to `changed`, from their modification time and size.
+
+    Polling keeps the watcher portable and dependency free. Editors and spreadsheet exports usually replace
+    files rather than writing them in place, which inotify-like watchers can miss.
+    """
+
+    def __init__(self, paths: Iterable[str]):
+        self._signatures: Dict[str, FileSignature] = {str(path): None for path in paths}
+
+    def changed(self) -> List[str]:
+        """Paths modified, created or deleted since the previous call: all existing paths on the first call"""
+
+        changed_paths = []
+        for path, signature in self._signatures.items():
+            new_signature = _file_signature(path)
+            if new_signature != signature:
+                self._signatures[path] = new_signature
+                changed_paths.append(path)
+        return changed_paths
+
+
+def watch(
+    watcher: FileWatcher,
+    on_change: Callable[[List[str]], None],
+    interval: float = 1.0,
+    sleep: Callable[[float], None] = time.sleep,
+    max_polls: Optional[int] = None,
+    input_errors: Tuple[Type[Exception], ...] = INPUT_ERRORS,
+):
+    """
+    Call `on_change` with the changed paths whenever files change, until interrupted.
+
+    `input_errors` raised by `on_change` are logged rather than raised: an invalid input file is expected to be
+    fixed by a later edit, and the watcher then runs again.
+    """
+
+    polls = 0
+    while max_polls is None or polls < max_polls:
+        polls += 1
+        changed_paths = watcher.changed()
+        if changed_paths:
+            logger.info(f"changed: {changed_paths}")
+            try:
+                on_change(changed_paths)
+            except input_errors as error:
+                logger.error(f"run failed, waiting for the next change: {error}")
+        sleep(interval)
+
+
+def _file_signature(path: str) -> FileSignature:
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)